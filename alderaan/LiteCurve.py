@@ -23,7 +23,7 @@ class LiteCurve:
         self.mask    = mask
         
         
-    def clip_outliers(self, kernel_size, sigma_upper, sigma_lower, mask=None):
+    def clip_outliers(self, kernel_size, sigma_upper, sigma_lower, mask=None, sigma_upper_all=None, sigma_lower_all=None):
         """
         Sigma-clip outliers using astropy.stats.sigma_clip() and a median filtered trend
         Applies an additional iteration wrapper to allow for masked cadences
@@ -38,20 +38,35 @@ class LiteCurve:
                 lower sigma clipping threshold
             mask : array-like, bool (optional)
                 do not reject cadences within masked regions; useful for protecting transits
+            sigma_upper_all : float (optional)
+                upper sigma clipping threshold applied to all cadences, including masked regions
+            sigma_lower_all : float (optional)
+                lower sigma clipping threshold applied to all cadences, including masked regions
         """
         if mask is None:
             mask = np.zeros(len(self.time), dtype='bool')
 
+        clip_all = (sigma_upper_all is not None) or (sigma_lower_all is not None)
+
+        if clip_all:
+            sigma_upper_all = np.inf if sigma_upper_all is None else sigma_upper_all
+            sigma_lower_all = np.inf if sigma_lower_all is None else sigma_lower_all
+
         loop = True
         count = 0
 
         while loop:
-            smoothed = sig.medfilt(self.flux, kernel_size=kernel_size)
+            resid = self.flux - sig.medfilt(self.flux, kernel_size=kernel_size)
 
-            bad = astropy.stats.sigma_clip(self.flux-smoothed, sigma_upper=sigma_upper, sigma_lower=sigma_lower,
+            bad = astropy.stats.sigma_clip(resid, sigma_upper=sigma_upper, sigma_lower=sigma_lower,
                                            stdfunc=astropy.stats.mad_std).mask
             bad = bad*~mask
 
+            # second set of thresholds reuses the same median filtered trend
+            if clip_all:
+                bad += astropy.stats.sigma_clip(resid, sigma_upper=sigma_upper_all, sigma_lower=sigma_lower_all,
+                                                stdfunc=astropy.stats.mad_std).mask
+
             for k in self.__dict__.keys():
                 if type(self.__dict__[k]) is np.ndarray:
                     self.__setattr__(k, self.__dict__[k][~bad])  
@@ -67,8 +82,8 @@ class LiteCurve:
                 loop = False
 
         return self
-    
-    
+
+
     def plot(self):
         """
         Plot the photometry
@@ -5,7 +5,8 @@ __all__ = ['Planet']
 
 class Planet:
     def __init__(self, period=None, epoch=None, depth=None, duration=None, impact=None,
-                 tts=None, index=None, quality=None, overlap=None, dtype=None):
+                 tts=None, index=None, quality=None, overlap=None, dtype=None,
+                 sc_windows=None, lc_windows=None):
 
         self.period   = period           # orbital period
         self.epoch    = epoch            # reference transit time in range (0, period)
@@ -16,4 +17,7 @@ class Planet:
         self.tts      = tts              # midtransit times
         self.index    = index            # index of each transit time
         self.quality  = quality          # bool flag per transit; True=good
-        self.overlap  = overlap          # bool flag per transit; True = transit overlaps with another planet
\ No newline at end of file
+        self.overlap  = overlap          # bool flag per transit; True = transit overlaps with another planet
+
+        self.sc_windows = sc_windows     # (2, N) [lo, hi) short cadence index bounds within 1.5 durations of each transit
+        self.lc_windows = lc_windows     # (2, N) [lo, hi) long cadence index bounds within 1.5 durations of each transit
\ No newline at end of file
@@ -1,25 +1,18 @@
-import astropy
 from   astropy.timeseries import LombScargle
-from   copy import deepcopy
+from   copy import copy
 import matplotlib.pyplot as plt
 import numpy as np
+import scipy.optimize as op
 import scipy.signal as sig
 from   scipy.interpolate import interp1d
 import warnings
 
-import pymc3 as pm
-import pymc3_ext as pmx
-import exoplanet as exo
-import aesara_theano_fallback.tensor as T
-from   aesara_theano_fallback import aesara as theano
-from   celerite2.theano import GaussianProcess
-from   celerite2.theano import terms as GPterms
-
 from .constants import *
 from .LiteCurve import LiteCurve
 
 
 __all__ = ['make_transitmask',
+           'make_transitmask_batched',
            'identify_gaps',
            'flatten_with_gp',
            'filter_ringing',
@@ -34,7 +27,7 @@ def make_transitmask(time, tts, masksize):
     Parameters
     ----------
         time : array-like
-            time values at each cadence
+            time values at each cadence; must be monotonically increasing
         tts : array-like
             transit times for a single planet
         masksize : float
@@ -44,14 +37,63 @@ def make_transitmask(time, tts, masksize):
     -------
         transitmask : array-like, bool
             boolean array (1=near transit; 0=not)
-    """  
-    transitmask = np.zeros(len(time), dtype='bool')
-    
+    """
     tts_here = tts[(tts >= time.min())*(tts <= time.max())]
+
+    # time is sorted, so each transit window is a contiguous range of cadences [lo, hi)
+    lo = np.searchsorted(time, tts_here - masksize, side='right')
+    hi = np.searchsorted(time, tts_here + masksize, side='left')
+
+    # mark window edges and accumulate; any cadence with a positive count is near a transit
+    delta = np.zeros(len(time)+1, dtype='int')
+    np.add.at(delta, lo, 1)
+    np.add.at(delta, hi, -1)
+
+    transitmask = np.cumsum(delta[:-1]) > 0
+
+    return transitmask
+
+
+def make_transitmask_batched(time, tts_list, masksizes):
+    """
+    Make transit masks for several Planets at once
+    Equivalent to stacking make_transitmask(time, tts_list[n], masksizes[n]) for each planet n
+    
+    Parameters
+    ----------
+        time : array-like
+            time values at each cadence; must be monotonically increasing
+        tts_list : list
+            transit times for each planet; entries may have different lengths
+        masksizes : array-like
+            size of mask window for each planet in same units as time
+    
+    Returns
+    -------
+        transitmask : ndarray, bool
+            boolean array of shape (len(tts_list), len(time)) (1=near transit; 0=not)
+    """
+    npl = len(tts_list)
+    counts = [len(tts) for tts in tts_list]
+    
+    # flatten transits from all planets, labelling each by planet (row) and window size
+    tts  = np.concatenate([np.asarray(tts, dtype='float') for tts in tts_list])
+    row  = np.repeat(np.arange(npl), counts)
+    size = np.repeat(np.asarray(masksizes, dtype='float'), counts)
+    
+    here = (tts >= time.min())*(tts <= time.max())
+    tts, row, size = tts[here], row[here], size[here]
+    
+    # time is sorted, so each transit window is a contiguous range of cadences [lo, hi)
+    lo = np.searchsorted(time, tts - size, side='right')
+    hi = np.searchsorted(time, tts + size, side='left')
+    
+    # mark window edges on each planet's row and accumulate along time
+    delta = np.zeros((npl, len(time)+1), dtype='int')
+    np.add.at(delta, (row, lo), 1)
+    np.add.at(delta, (row, hi), -1)
     
-    for t0 in tts_here:
-        neartransit = np.abs(time-t0) < masksize
-        transitmask += neartransit
+    transitmask = np.cumsum(delta[:,:-1], axis=1) > 0
     
     return transitmask
 
@@ -75,24 +117,26 @@ def identify_gaps(lc, break_tolerance, jump_tolerance=5.0):
             array of indexes corresponding to the locations of gaps in lc.flux
     """
     # 1D mask
-    mask = np.sum(np.atleast_2d(lc.mask, 0) == 0)
+    if lc.mask is None:
+        mask = np.ones(len(lc.time), dtype='bool')
+    else:
+        mask = ~np.asarray(lc.mask, dtype='bool')
     
     # identify time gaps
-    breaks = lc.cadno[1:]-lc.cadno[:-1]
-    breaks = np.pad(breaks, (1,0), 'constant', constant_values=(1,0))
+    breaks = np.diff(lc.cadno, prepend=lc.cadno[0]-1)
     break_locs = np.where(breaks > break_tolerance)[0]
     break_locs = np.pad(break_locs, (1,1), 'constant', constant_values=(0,len(breaks)+1))
     
-    # identify flux jumps
-    jumps = lc.flux[1:]-lc.flux[:-1]
-    jumps = np.pad(jumps, (1,0), 'constant', constant_values=(0,0))
-    big_jump = np.abs(jumps - np.median(jumps))/astropy.stats.mad_std(jumps) > 5.0
-    jump_locs = np.where(mask*big_jump)[0]
+    # identify flux jumps (inline MAD avoids the astropy.stats call on this hot path)
+    jumps = np.diff(lc.flux, prepend=lc.flux[0])
+    dev = np.abs(jumps - np.median(jumps))
+    big_jump = dev > jump_tolerance*1.4826*np.median(dev)
+    jump_locs = np.where(mask & big_jump)[0]
     
-    gaps = np.sort(np.unique(np.hstack([break_locs, jump_locs])))
+    gaps = np.union1d(break_locs, jump_locs)
     
     # flag nearly-consecutive cadences identified as gaps
-    bad = np.hstack([False, (gaps[1:] - gaps[:-1]) < break_tolerance])
+    bad = np.concatenate([[False], np.diff(gaps) < break_tolerance])
 
     if bad[-1]:
         bad[-1] = False
@@ -103,6 +147,119 @@ def identify_gaps(lc, break_tolerance, jump_tolerance=5.0):
     return gaps
 
 
+def _optimize_stages(model, start, stages):
+    """
+    Run a sequence of MAP optimizations, each over a subset of the free variables
+    
+    The objective and gradient are compiled once for the full set of continuous variables;
+    variables not included in a stage are held fixed by collapsing their L-BFGS-B bounds.
+    Like pmx.optimize, the objective is model.logpt, including the Jacobian terms of transformed
+    variables, and a stage result is only kept if it improves on that stage's starting point.
+    
+    Parameters
+    ----------
+        model : pm.Model
+            model to be optimized
+        start : dict
+            starting point
+        stages : list
+            each entry is a list of variables to optimize, or None to optimize all variables
+    
+    Returns
+    -------
+        map_soln : dict
+            optimized point, including transformed and deterministic variables
+    """
+    import pymc3 as pm
+    from   pymc3.theanof import inputvars
+    from   pymc3.util import get_default_varnames
+    
+    grad_vars = inputvars(model.cont_vars)
+    bij = pm.blocking.DictToArrayBijection(pm.blocking.ArrayOrdering(grad_vars), start)
+    
+    logp  = bij.mapf(model.fastlogp)
+    dlogp = bij.mapf(model.fastdlogp(grad_vars))
+    
+    def neg_logp_and_grad(x):
+        return -logp(x), -dlogp(x)
+    
+    x = bij.map(start)
+    
+    for stage in stages:
+        bounds = [(None, None)]*len(x)
+        
+        if stage is not None:
+            free = [v.name for v in inputvars(stage)]
+            
+            for v in grad_vars:
+                if v.name not in free:
+                    slc = bij.ordering.by_name[v.name].slc
+                    bounds[slc] = [(x_, x_) for x_ in x[slc]]
+                    
+        fun_init = -logp(x)
+        res = op.minimize(neg_logp_and_grad, x, jac=True, method='L-BFGS-B', bounds=bounds)
+        
+        if np.isfinite(res.fun) and np.all(np.isfinite(res.x)) and (res.fun < fun_init):
+            x = res.x
+        else:
+            warnings.warn("GP hyperparameter optimization stage did not improve; keeping previous stage")
+        
+    point = bij.rmap(x)
+    varnames = get_default_varnames(model.unobserved_RVs, include_transformed=True)
+    
+    return {v.name: val for v, val in zip(varnames, model.fastfn(varnames)(point))}
+
+
+# compiled GP prediction functions, keyed by kernel term
+_PREDICT_CACHE = {}
+
+
+def _get_gp_predict(kterm):
+    """
+    Compile (once per kernel term) a function returning the GP conditional mean
+    
+    Parameters
+    ----------
+        kterm : string
+            must be either 'RotationTerm' or 'SHOTerm'
+    
+    Returns
+    -------
+        gp_predict : function
+            called as gp_predict(sigma, P, log_Q0, log_dQ, mix, log_yvar, t, y, t_pred)
+    """
+    if kterm in _PREDICT_CACHE:
+        return _PREDICT_CACHE[kterm]
+    
+    import aesara_theano_fallback.tensor as T
+    from   aesara_theano_fallback import aesara as theano
+    from   celerite2.theano import GaussianProcess
+    from   celerite2.theano import terms as GPterms
+    
+    sigma, P, log_Q0, log_dQ, mix, log_yvar = [T.dscalar() for i in range(6)]
+    t, y, t_pred = [T.dvector() for i in range(3)]
+    
+    if kterm == 'RotationTerm':
+        kernel = GPterms.RotationTerm(sigma=sigma, period=P, Q0=T.exp(log_Q0), dQ=T.exp(log_dQ), f=mix)
+    
+    elif kterm == 'SHOTerm':
+        kernel = GPterms.SHOTerm(sigma=sigma, w0=2*pi/P, Q=0.5 + T.exp(log_Q0))
+        
+    else:
+        raise ValueError("kterm must be 'RotationTerm' or 'SHOTerm'")
+    
+    gp = GaussianProcess(kernel, mean=0.0)
+    gp.compute(t, diag=T.exp(log_yvar)*T.ones_like(t))
+    
+    gp_predict = theano.function([sigma, P, log_Q0, log_dQ, mix, log_yvar, t, y, t_pred], 
+                                 gp.predict(y, t_pred), 
+                                 on_unused_input='ignore')
+    
+    _PREDICT_CACHE[kterm] = gp_predict
+    
+    return gp_predict
+
+
 def flatten_with_gp(lc, break_tolerance, min_period, kterm='RotationTerm', correct_ramp=True, return_trend=False):
     """
     Remove trends from a LiteCurve using celerite Gaussian processes
@@ -127,10 +284,18 @@ def flatten_with_gp(lc, break_tolerance, min_period, kterm='RotationTerm', corre
         lc : LiteCurve
             alderaan.LiteCurve() with lc.flux and lc.error flattened and normalized
     """
+    # heavy modeling dependencies are only needed here, so defer their import
+    import pymc3 as pm
+    import aesara_theano_fallback.tensor as T
+    from   celerite2.theano import GaussianProcess
+    from   celerite2.theano import terms as GPterms
+    
     # identify primary oscillation period
     ls_estimate = LombScargle(lc.time, lc.flux)
     xf, yf = ls_estimate.autopower(minimum_frequency=1/(lc.time.max()-lc.time.min()), 
-                                   maximum_frequency=1/min_period)
+                                   maximum_frequency=1/min_period,
+                                   method='fast',
+                                   samples_per_peak=3)
     
     peak_freq = xf[np.argmax(yf)]
     peak_per  = 1/peak_freq
@@ -142,37 +307,27 @@ def flatten_with_gp(lc, break_tolerance, min_period, kterm='RotationTerm', corre
     
     # make adjustments for masked transits        
     inds_ = np.arange(len(lc.time), dtype='int')[~lc.mask]
-    gaps_ = [np.sum(inds_ < g) for g in gaps]
+    gaps_ = np.searchsorted(inds_, gaps)
     time_ = lc.time[~lc.mask]
     flux_ = lc.flux[~lc.mask]    
     
     # break up data into segments bases on gaps/jumps 
-    seg  = np.zeros(len(lc.time), dtype='int')
-    seg_ = np.zeros(len(time_), dtype='int')
-    
-    for i in range(nseg):
-        seg[gaps[i]:gaps[i+1]] = i
-        seg_[gaps_[i]:gaps_[i+1]] = i
+    seg  = np.repeat(np.arange(nseg, dtype='int'), np.diff(gaps))
+    seg_ = np.repeat(np.arange(nseg, dtype='int'), np.diff(gaps_))
     
     # define the mean function (exponential ramp)
+    # _t and _s are numpy constants, so segment start times can be tabulated up front
+    # and per-segment parameters broadcast to each cadence via integer indexing
     if correct_ramp:
         def mean_fxn(_t, _s, flux0, ramp_amp, log_tau):
-            mean = T.zeros(len(_t))
-
-            for i in range(len(np.unique(_s))):
-                t0 = _t[_s == i].min()
-                mean += flux0[i]*(1 + ramp_amp[i]*T.exp(-(_t-t0)/T.exp(log_tau[i])))*(_s == i)
-
-            return mean
+            t0 = np.full(nseg, np.inf)
+            np.minimum.at(t0, _s, _t)
+            
+            return flux0[_s]*(1 + ramp_amp[_s]*T.exp(-(_t-t0[_s])/T.exp(log_tau[_s])))
         
     else:
         def mean_fxn(_t, _s, flux0, ramp_amp=None, log_tau=None):
-            mean = T.zeros(len(_t))
-            
-            for i in range(len(np.unique(_s))):
-                mean += flux0[i]*(_s == i)
-                
-            return mean
+            return flux0[_s]
     
     # here's the stellar rotation model
     with pm.Model() as trend_model:
@@ -212,7 +367,12 @@ def flatten_with_gp(lc, break_tolerance, min_period, kterm='RotationTerm', corre
             mean_    = pm.Deterministic('mean_', mean_fxn(time_, seg_, flux0))
             
         # variance
-        log_yvar = pm.Normal('log_yvar', mu=np.var(flux_ - sig.medfilt(flux_,13)), sd=5.0)
+        # (white noise estimate from point-to-point scatter; var(diff) = 2*var)
+        # (fall back to the total variance if over half the consecutive fluxes are equal)
+        yvar_est = 0.5*(1.4826*np.median(np.abs(np.diff(flux_))))**2
+        if yvar_est <= 0:
+            yvar_est = np.var(flux_)
+        log_yvar = pm.Normal('log_yvar', mu=np.log(np.max([yvar_est, np.finfo(float).tiny])), sd=5.0)
 
         # now set up the GP
         gp = GaussianProcess(kernel, t=time_, diag=T.exp(log_yvar)*T.ones(len(time_)), mean=mean_)
@@ -222,40 +382,33 @@ def flatten_with_gp(lc, break_tolerance, min_period, kterm='RotationTerm', corre
         full_mean_pred = pm.Deterministic('full_mean_pred', mean_fxn(lc.time, seg, flux0, ramp_amp, log_tau))
         
     # optimize the GP hyperparameters
-    with trend_model:
-        trend_map = trend_model.test_point
-        trend_map = pmx.optimize(start=trend_map, vars=[flux0])
-        trend_map = pmx.optimize(start=trend_map, vars=[flux0, log_yvar])
-        
-        for i in range(1 + correct_ramp):
-            if kterm == 'RotationTerm':
-                trend_map = pmx.optimize(start=trend_map, vars=[log_yvar, flux0, sigma, P, log_Q0, log_dQ, mix])
-            if kterm == 'SHOTerm':
-                trend_map = pmx.optimize(start=trend_map, vars=[log_yvar, flux0, sigma, P, log_Q0])
-            if correct_ramp:
-                trend_map = pmx.optimize(start=trend_map, vars=[log_yvar, flux0, ramp_amp, log_tau])
-                
-        trend_map = pmx.optimize(start=trend_map)     
+    stages = [[flux0], [flux0, log_yvar]]
+    
+    for i in range(1 + correct_ramp):
+        if kterm == 'RotationTerm':
+            stages.append([log_yvar, flux0, sigma, P, log_Q0, log_dQ, mix])
+        if kterm == 'SHOTerm':
+            stages.append([log_yvar, flux0, sigma, P, log_Q0])
+        if correct_ramp:
+            stages.append([log_yvar, flux0, ramp_amp, log_tau])
+            
+    stages.append(None)
+    
+    trend_map = _optimize_stages(trend_model, trend_model.test_point, stages)
         
     # reconstruct the GP to interpolate over masked transits
-    if kterm == 'RotationTerm':
-        kernel = GPterms.RotationTerm(sigma  = trend_map['sigma'], 
-                                      period = trend_map['P'], 
-                                      Q0 = T.exp(trend_map['log_Q0']),
-                                      dQ = T.exp(trend_map['log_dQ']),
-                                      f  = trend_map['mix']
-                                     )
-                                      
-    elif kterm == 'SHOTerm':
-        kernel = GPterms.SHOTerm(sigma = trend_map['sigma'], 
-                                 w0 = 2*pi/trend_map['P'], 
-                                 Q  = 0.5 + T.exp(trend_map['log_Q0'])
-                                )
+    gp_predict = _get_gp_predict(kterm)
     
-    gp = GaussianProcess(kernel, mean=0.0)
-    gp.compute(time_, diag=T.exp(trend_map['log_yvar'])*T.ones(len(time_)))
-        
-    full_trend =  gp.predict(flux_-trend_map['mean_'], lc.time).eval() + trend_map['full_mean_pred']
+    full_trend = gp_predict(trend_map['sigma'],
+                            trend_map['P'],
+                            trend_map['log_Q0'],
+                            trend_map.get('log_dQ', 0.0),
+                            trend_map.get('mix', 0.0),
+                            trend_map['log_yvar'],
+                            time_,
+                            flux_-trend_map['mean_'],
+                            lc.time
+                           ) + trend_map['full_mean_pred']
     
     lc.flux /= full_trend
     lc.error /= full_trend
@@ -307,26 +460,19 @@ def filter_ringing(lc, break_tolerance, fring, bw):
         npts = c[-1]-c[0] + 1
         dt = np.min(t[1:]-t[:-1])
 
-        t_interp = np.linspace(t.min(),t.max()+dt*3/2, npts)
-        f_interp = np.ones_like(t_interp)
-        c_interp = np.arange(c.min(), c.max()+1)
-
-        data_exists = np.isin(c_interp, c)
-
-        f_interp[data_exists] = f
-        f_interp[~data_exists] = np.random.normal(loc=np.median(f), scale=np.std(f), size=np.sum(~data_exists))
+        # cadence numbers are sorted integers, so they index the interpolation grid directly
+        idx = c - c[0]
         
-        # now apply the filter
-        f_fwd_back = np.copy(f_interp)
-        f_back_fwd = np.copy(f_interp)
-        f_ramp = np.linspace(0,1,len(f_interp))
+        data_exists = np.zeros(npts, dtype='bool')
+        data_exists[idx] = True
+
+        f_interp = np.empty(npts)
+        f_interp[idx] = f
+        f_interp[~data_exists] = np.random.normal(loc=np.median(f), scale=np.std(f), size=npts-len(c))
         
-        for j, f0 in enumerate(fring):
-            b, a = sig.iirnotch(f0, Q=2*f0/bw, fs=1/dt)
-            f_fwd_back = sig.filtfilt(b, a, f_fwd_back, padlen=np.min([120, len(f_fwd_back)-2]))
-            f_back_fwd = sig.filtfilt(b, a, f_back_fwd[::-1], padlen=np.min([120, len(f_back_fwd/2)-1]))[::-1]
-            
-            f_filt = f_fwd_back*f_ramp + f_fwd_back*f_ramp[::-1]
+        # now apply the filter (all notches cascaded as second-order sections; zero-phase)
+        sos = np.vstack([sig.tf2sos(*sig.iirnotch(f0, Q=2*f0/bw, fs=1/dt)) for f0 in fring])
+        f_filt = sig.sosfiltfilt(sos, f_interp, padlen=np.min([120, len(f_interp)-2]))
             
         flux_filtered.append(f_filt[data_exists])
           
@@ -337,11 +483,12 @@ def stitch(litecurves):
     """
     Combine a list of LiteCurves in a single LiteCurve
     """
-    combo = deepcopy(litecurves[0])
+    # shallow copy is sufficient because every array attribute is replaced below
+    combo = copy(litecurves[0])
     
-    for i in range(1,len(litecurves)):
-        for k in combo.__dict__.keys():
-            if type(combo.__dict__[k]) is np.ndarray:
-                combo.__dict__[k] = np.hstack([combo.__dict__[k], litecurves[i].__dict__[k]])
+    # concatenate each array attribute in a single pass
+    for k in combo.__dict__.keys():
+        if type(combo.__dict__[k]) is np.ndarray:
+            combo.__dict__[k] = np.concatenate([lc.__dict__[k] for lc in litecurves])
             
     return combo
\ No newline at end of file
@@ -1,5 +1,4 @@
 from   astropy.io import fits
-from   copy import deepcopy
 import lightkurve as lk
 import numpy as np
 
@@ -29,24 +28,16 @@ def cleanup_lkfc(lk_collection, kic):
         lkc : lk.LightCurveCollection
             lk.LightCurveCollection() with only one entry per quarter
     """
-    lk_col = deepcopy(lk_collection)
-    
-    quarters = []
-    for i, lkc in enumerate(lk_col):
-        quarters.append(lkc.quarter)
+    # group light curves for this target by quarter in a single pass
+    by_quarter = {}
+    for lkc in lk_collection:
+        members = by_quarter.setdefault(lkc.quarter, [])
+        if lkc.targetid == kic:
+            members.append(lkc)
 
     data_out = []
-    for q in np.unique(quarters):
-        lkc_list = []
-        cadno   = []
-
-        for i, lkc in enumerate(lk_col):
-            if (lkc.quarter == q)*(lkc.targetid==kic):
-                lkc_list.append(lkc)
-                cadno.append(lkc.cadenceno.min())
-        
-        order = np.argsort(cadno)
-        lkc_list = [lkc_list[j] for j in order]
+    for q in sorted(by_quarter):
+        lkc_list = sorted(by_quarter[q], key=lambda lkc: lkc.cadenceno.min())
 
         # the operation "stitch" converts a LightCurveCollection to a single LightCurve
         lkc = lk.LightCurveCollection(lkc_list).stitch().remove_nans()
@@ -57,13 +48,15 @@ def cleanup_lkfc(lk_collection, kic):
 
 
 def LightKurve_to_LiteCurve(lklc):
-    return LiteCurve(time    = np.array(lklc.time.value, dtype='float'),
-                     flux    = np.array(lklc.flux.value, dtype='float'),
-                     error   = np.array(lklc.flux_err.value, dtype='float'),
-                     cadno   = np.array(lklc.cadenceno.value, dtype='int'),
-                     quarter = lklc.quarter*np.ones(len(lklc.time), dtype='int'),
-                     season  = (lklc.quarter%4)*np.ones(len(lklc.time), dtype='int'),
-                     channel = lklc.channel*np.ones(len(lklc.time), dtype='int'),
+    npts = len(lklc.time)
+    
+    return LiteCurve(time    = np.asarray(lklc.time.value, dtype='float'),
+                     flux    = np.asarray(lklc.flux.value, dtype='float'),
+                     error   = np.asarray(lklc.flux_err.value, dtype='float'),
+                     cadno   = np.asarray(lklc.cadenceno.value, dtype='int'),
+                     quarter = np.full(npts, lklc.quarter, dtype='int'),
+                     season  = np.full(npts, lklc.quarter%4, dtype='int'),
+                     channel = np.full(npts, lklc.channel, dtype='int'),
                      quality = lklc.quality.value
                     )
 
@@ -84,12 +77,13 @@ def load_detrended_lightcurve(filename):
     litecurve = LiteCurve() 
     
     with fits.open(filename) as hdulist:
+        # time keeps full precision; detrended flux, error and integer labels are downcast
         litecurve.time    = np.array(hdulist['TIME'].data, dtype='float64')
-        litecurve.flux    = np.array(hdulist['FLUX'].data, dtype='float64')
-        litecurve.error   = np.array(hdulist['ERROR'].data, dtype='float64')
-        litecurve.cadno   = np.array(hdulist['CADNO'].data, dtype='int')
-        litecurve.quarter = np.array(hdulist['QUARTER'].data, dtype='int')
-        litecurve.channel = np.array(hdulist['CHANNEL'].data, dtype='int')
+        litecurve.flux    = np.array(hdulist['FLUX'].data, dtype='float32')
+        litecurve.error   = np.array(hdulist['ERROR'].data, dtype='float32')
+        litecurve.cadno   = np.array(hdulist['CADNO'].data, dtype='int32')
+        litecurve.quarter = np.array(hdulist['QUARTER'].data, dtype='int16')
+        litecurve.channel = np.array(hdulist['CHANNEL'].data, dtype='int16')
         litecurve.mask    = np.asarray(hdulist['MASK'].data, dtype='bool')
         
     return litecurve    
\ No newline at end of file
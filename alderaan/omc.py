@@ -1,12 +1,16 @@
 import numpy as np
+from   scipy import optimize
+from   scipy import special
 from   scipy import stats
 from   sklearn.cluster import KMeans
+import warnings
 
 import pymc3 as pm
 import pymc3_ext as pmx
 import exoplanet as exo
 import aesara_theano_fallback.tensor as T
 from   aesara_theano_fallback import aesara as theano
+import celerite2
 from   celerite2.theano import GaussianProcess
 from   celerite2.theano import terms as GPterms
 
@@ -14,6 +18,7 @@ from .constants import *
 
 
 __all__ = ['matern32_model',
+           'matern32_map',
            'poly_model',
            'sin_model',
            'mix_model',
@@ -65,13 +70,103 @@ def matern32_model(xtime, yomc, xt_predict=None):
 
         gp.marginal('gp', observed=yomc)
 
-        # track GP prediction
-        trend = pm.Deterministic('trend', gp.predict(yomc, xtime) + mean)
-        pred  = pm.Deterministic('pred', gp.predict(yomc, xt_predict) + mean)
+        # track GP prediction (celerite2 predictions already include the mean)
+        trend = pm.Deterministic('trend', gp.predict(yomc, xtime))
+        pred  = pm.Deterministic('pred', gp.predict(yomc, xt_predict))
         
     return model
 
 
+def matern32_map(xtime, yomc, xt_predict=None):
+    """
+    Find the maximum a posteriori (MAP) regularized Matern-3/2 GP fit to TTV observed-minus-calculated data
+    Uses the same priors as matern32_model() but optimizes with scipy + celerite2 directly, bypassing PyMC3
+    Like pmx.optimize() on matern32_model(), rho is optimized on its interval (logit) transform, including
+    the Jacobian of that transform, starting from the model test point
+    
+    Parameters
+    ----------
+    xtime : ndarray
+        time values (e.g. linear ephemeris)
+    yomc : ndarray
+        observed-minus-caculated TTVs
+    xt_predict : ndarray
+        time values to predict OMC model; if not provided xtime will be used
+
+    Returns
+    -------
+    map_soln : dict
+        MAP values of 'log_sigma', 'rho', 'mean', 'log_yvar' and GP predictions 'trend' and 'pred'
+    """
+    # times where trend will be predicted
+    if xt_predict is None:
+        xt_predict = xtime
+    
+    # delta between each transit time sets lower bound on rho
+    dx = np.mean(np.diff(xtime))
+    rho_lower = 2*dx
+    rho_upper = xtime.max()-xtime.min()
+    
+    # Normal priors on (log_sigma, mean, log_yvar)
+    mu = np.array([np.log(np.std(yomc)), np.mean(yomc), np.log(np.var(yomc))])
+    sd = np.array([5.0, np.std(yomc), 10.0])
+    
+    def to_rho(rho_interval):
+        return rho_lower + (rho_upper - rho_lower)*special.expit(rho_interval)
+    
+    def build_gp(log_sigma, rho, mean, log_yvar):
+        kernel = celerite2.terms.Matern32Term(sigma=np.exp(log_sigma), rho=rho)
+        gp = celerite2.GaussianProcess(kernel, mean=mean)
+        gp.compute(xtime, diag=np.exp(log_yvar)*np.ones(len(xtime)))
+        
+        return gp
+    
+    def neg_log_prob(theta):
+        log_sigma, rho_interval, mean, log_yvar = theta
+        rho = to_rho(rho_interval)
+        
+        # Normal priors, uniform prior on rho (constant), Jacobian of the interval transform,
+        # and the 2*log(rho) regularization penalty
+        log_prior = np.sum(stats.norm.logpdf([log_sigma, mean, log_yvar], loc=mu, scale=sd))
+        log_prior += np.log(rho - rho_lower) + np.log(rho_upper - rho) + 2*np.log(rho)
+        
+        try:
+            gp = build_gp(log_sigma, rho, mean, log_yvar)
+        except celerite2.driver.LinAlgError:
+            return np.inf
+        
+        return -(log_prior + gp.log_likelihood(yomc))
+    
+    # test point of matern32_model(); the interval transform maps the midpoint of rho to zero
+    theta0 = np.array([mu[0], 0.0, mu[1], mu[2]])
+    
+    res = optimize.minimize(neg_log_prob, theta0, method='L-BFGS-B')
+    
+    # as in pmx.optimize(), only accept the result if it improved on the starting point
+    if np.isfinite(res.fun) and np.all(np.isfinite(res.x)) and (res.fun < neg_log_prob(theta0)):
+        theta = res.x
+        if not res.success:
+            warnings.warn("Matern-3/2 MAP optimization did not converge ({0})".format(res.message))
+    else:
+        warnings.warn("Matern-3/2 MAP optimization failed; returning starting point")
+        theta = theta0
+    
+    log_sigma, rho, mean, log_yvar = theta[0], to_rho(theta[1]), theta[2], theta[3]
+    
+    # celerite2 predictions include the mean function
+    gp = build_gp(log_sigma, rho, mean, log_yvar)
+    
+    map_soln = {'log_sigma' : log_sigma,
+                'rho'       : rho,
+                'mean'      : mean,
+                'log_yvar'  : log_yvar,
+                'trend'     : gp.predict(yomc, t=xtime),
+                'pred'      : gp.predict(yomc, t=xt_predict)
+               }
+    
+    return map_soln
+
+
 def poly_model(xtime, yomc, polyorder, xt_predict=None):
     """
     Build a PyMC3 model to fit TTV observed-minus-calculated data 
@@ -18,6 +18,9 @@ __all__ = ['get_transit_depth',
            'get_dur_23',
            'get_dur_cc',
            'boxcar_smooth',
+           'linfit',
+           'linfit_eval',
+           'slide_chisq',
            'FFT_estimator',
            'LS_estimator',
            'bin_data',
@@ -203,6 +206,124 @@ def boxcar_smooth(x, winsize, passes=1):
     return xsmooth
 
 
+def linfit(x, y):
+    """
+    Fit a straight line by least squares
+    Closed-form equivalent of poly.polyfit(x, y, 1)
+    
+    Parameters
+    ----------
+    x : ndarray
+        independent variable
+    y : ndarray
+        dependent variable
+            
+    Returns
+    -------
+    coeffs : tuple
+        (intercept, slope), ordered as returned by poly.polyfit()
+    """
+    # center the data to avoid cancellation in the normal equations
+    x_mean = np.mean(x)
+    y_mean = np.mean(y)
+    dx = x - x_mean
+    
+    slope = np.sum(dx*(y - y_mean))/np.sum(dx**2)
+    intercept = y_mean - slope*x_mean
+    
+    return intercept, slope
+
+
+def linfit_eval(x_fit, y_fit, x_eval):
+    """
+    Fit a straight line by least squares and evaluate it
+    Closed-form equivalent of poly.polyval(x_eval, poly.polyfit(x_fit, y_fit, 1))
+    
+    Parameters
+    ----------
+    x_fit : ndarray
+        independent variable of data to be fit
+    y_fit : ndarray
+        dependent variable of data to be fit
+    x_eval : ndarray
+        values at which to evaluate the fitted line
+            
+    Returns
+    -------
+    y_eval : ndarray
+        fitted line evaluated at x_eval
+    coeffs : tuple
+        (intercept, slope), ordered as returned by poly.polyfit()
+    """
+    intercept, slope = linfit(x_fit, y_fit)
+    
+    return intercept + slope*np.asarray(x_eval), (intercept, slope)
+
+
+def slide_chisq(t, f, e, template_time, template_flux, tc_vector):
+    """
+    Calculate chi-square of a transit template slid across a data window
+    
+    Equivalent to evaluating sum((f - interp(t - tc, template_time, template_flux))**2/e**2)
+    for every tc in tc_vector, but computed for all offsets at once via FFT cross-correlation
+    
+    Parameters
+    ----------
+    t : ndarray
+        time values of data
+    f : ndarray
+        flux values of data
+    e : ndarray or float
+        flux uncertainties (a scalar applies a uniform uncertainty)
+    template_time : ndarray
+        uniformly spaced time grid of template, centered on zero
+    template_flux : ndarray
+        template flux values
+    tc_vector : ndarray
+        trial transit centers; must share the uniform spacing of template_time
+        
+    Returns
+    -------
+    chisq_vector : ndarray
+        chi-square at each tc
+    """
+    # work with deviations from unity to avoid cancellation
+    w = 1/e**2
+    d = f - 1.0
+    s = template_flux - 1.0
+    
+    # fractional template index of each data point at the first trial offset
+    dt = template_time[1] - template_time[0]
+    u  = (t - tc_vector[0] - template_time[0])/dt
+    n  = np.floor(u).astype('int')
+    phi = u - n
+    
+    # shift j moves a data point from template index u to u-j; pad template with edge values (np.interp clamps)
+    ntc = len(tc_vector)
+    nmin, nmax = n.min(), n.max()
+    
+    pad_lo = np.max([0, ntc - 1 - nmin])
+    pad_hi = np.max([0, nmax + 2 - len(s)])
+    s = np.pad(s, (pad_lo, pad_hi), mode='edge')
+    
+    # linear interpolation weights deposited onto template-index combs
+    n_ = n - nmin
+    size = nmax - nmin + 2
+    
+    comb_lin = np.bincount(n_, w*d*(1-phi), size) + np.bincount(n_+1, w*d*phi, size)
+    comb_sq  = np.bincount(n_, w*(1-phi)**2, size) + np.bincount(n_+1, w*phi**2, size)
+    comb_x   = np.bincount(n_, 2*w*phi*(1-phi), size)
+    
+    # cross-correlate combs against template terms; offset j starts at index (nmin + pad_lo - j)
+    lags = nmin + pad_lo - np.arange(ntc)
+    
+    r_lin = sig.correlate(s, comb_lin, mode='valid', method='fft')[lags]
+    r_sq  = sig.correlate(s**2, comb_sq, mode='valid', method='fft')[lags]
+    r_x   = sig.correlate(s[:-1]*s[1:], comb_x[:-1], mode='valid', method='fft')[lags]
+    
+    return np.sum(w*d**2) - 2*r_lin + r_sq + r_x
+
+
 def FFT_estimator(x, y, fmin=None, fmax=None, crit_fap=0.003, nboot=1000, return_levels=False, max_peaks=2):
     """
     Identify significant frequencies in a (uniformly sampled) data series
@@ -414,16 +535,25 @@ def bin_data(time, data, binsize):
     binned_data : ndarray
         data binned to selcted binsize
     """
-    bin_centers = np.hstack([np.arange(time.mean(),time.min()-binsize/2,-binsize),
-                            np.arange(time.mean(),time.max()+binsize/2,binsize)])
+    # bin centers are spaced by binsize outward from the mean time to cover the full time range
+    tmean = time.mean()
+    nlo = int(np.ceil((tmean - time.min() + binsize/2)/binsize))
+    nhi = int(np.ceil((time.max() + binsize/2 - tmean)/binsize))
+    
+    bin_centers = tmean + np.arange(1-nlo, nhi)*binsize
+    
+    # assign each point to its nearest center; points exactly on a bin edge belong to neither bin
+    inds = np.clip(np.floor((time - tmean)/binsize + 0.5).astype('int') + nlo - 1, 0, len(bin_centers)-1)
+    use  = np.abs(time - bin_centers[inds]) < binsize/2
     
-    bin_centers = np.sort(np.unique(bin_centers))
-    binned_data = []
+    counts = np.bincount(inds[use], minlength=len(bin_centers))
+    sums   = np.bincount(inds[use], weights=data[use], minlength=len(bin_centers))
     
-    for i, t0 in enumerate(bin_centers):
-        binned_data.append(np.mean(data[np.abs(time-t0) < binsize/2]))
+    # empty bins are NaN
+    with np.errstate(invalid='ignore', divide='ignore'):
+        binned_data = sums/counts
         
-    return bin_centers, np.array(binned_data)
+    return bin_centers, binned_data
 
 
 def autocorr_length(x):
@@ -13,6 +13,8 @@ import sys
 import glob
 import shutil
 import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
 from datetime import datetime
 from timeit import default_timer as timer
 
@@ -45,6 +47,14 @@ parser.add_argument("--catalog", default=None, type=str, required=True,
                     help="CSV file containing input planet parameters; should be placed in <project_dir>/Catalogs/")
 parser.add_argument("--interactive", default=False, type=bool, required=False,
                     help="'True' to enable interactive plotting; by default matplotlib backend will be set to 'Agg'")
+parser.add_argument("--compiledir", default=None, type=str, required=False,
+                    help="Persistent base directory for theano/aesara compiled modules, shared across targets; \
+                          modules are keyed on platform, compiler and library versions, so a stale cache is \
+                          recompiled rather than reused, but include a version tag in the path to start fresh")
+parser.add_argument("--no_plots", action="store_true", required=False,
+                    help="Skip the final phase-folded transit plots when not plotting interactively")
+parser.add_argument("--n_jobs", default=1, type=int, required=False,
+                    help="Number of worker processes used to detrend quarters in parallel; default is serial")
 
 args = parser.parse_args()
 MISSION      = args.mission
@@ -61,6 +71,13 @@ if args.interactive == False:
 # set environment variables
 sys.path.append(PROJECT_DIR)
 
+# pin the theano/aesara compilation cache so compiled graphs are reused across targets
+# (must be set before theano/aesara is imported)
+if args.compiledir is not None:
+    for key in ['THEANO_FLAGS', 'AESARA_FLAGS']:
+        flags = [f for f in os.environ.get(key, '').split(',') if f]
+        os.environ[key] = ','.join(flags + ['base_compiledir={0}'.format(args.compiledir)])
+
 
 # echo pipeline info
 print("")
@@ -84,20 +101,8 @@ DLC_DIR       = PROJECT_DIR + 'Detrended_lightcurves/' + TARGET + '/'
 NOISE_DIR     = PROJECT_DIR + 'Noise_models/' + TARGET + '/'
 
 # check if all the output directories exist and if not, create them
-if os.path.exists(FIGURE_DIR) == False:
-    os.mkdir(FIGURE_DIR)
-
-if os.path.exists(TRACE_DIR) == False:
-    os.mkdir(TRACE_DIR)
-    
-if os.path.exists(QUICK_TTV_DIR) == False:
-    os.mkdir(QUICK_TTV_DIR)
-    
-if os.path.exists(DLC_DIR) == False:
-    os.mkdir(DLC_DIR)
-    
-if os.path.exists(NOISE_DIR) == False:
-    os.mkdir(NOISE_DIR)
+for d in [FIGURE_DIR, TRACE_DIR, QUICK_TTV_DIR, DLC_DIR, NOISE_DIR]:
+    os.makedirs(d, exist_ok=True)
 
 
 # import packages
@@ -108,7 +113,7 @@ import glob
 import lightkurve as lk
 import matplotlib.pyplot as plt
 import numpy as np
-import numpy.polynomial.polynomial as poly
+from   numpy.lib.stride_tricks import sliding_window_view
 import pandas as pd
 from   scipy import ndimage
 from   scipy import stats
@@ -118,11 +123,12 @@ import pymc3_ext as pmx
 import exoplanet as exo
 import aesara_theano_fallback.tensor as T
 from   aesara_theano_fallback import aesara as theano
+import celerite2
 from   celerite2.theano import GaussianProcess
 from   celerite2.theano import terms as GPterms
 
 from   alderaan.constants import *
-from   alderaan.utils import bin_data, boxcar_smooth, get_transit_depth, LS_estimator
+from   alderaan.utils import bin_data, boxcar_smooth, get_transit_depth, linfit, linfit_eval, LS_estimator, slide_chisq
 import alderaan.detrend as detrend
 import alderaan.io as io
 import alderaan.omc as omc
@@ -140,6 +146,9 @@ if np.any(np.array(['agg', 'png', 'svg', 'pdf', 'ps']) == mpl.get_backend()):
     iplot = False
 else:
     iplot = True
+
+# skip optional diagnostic figures in non-interactive batch runs if requested
+make_plots = iplot or not args.no_plots
     
 # echo theano cache directory
 print("theano cache: {0}\n".format(theano.config.compiledir))
@@ -165,19 +174,19 @@ else:
     raise ValueError("MISSION must be 'Kepler' or 'Simulated'")
 
 # pull relevant quantities and establish GLOBAL variables
-use = np.array(target_dict['koi_id']) == KOI_ID
+target_rows = target_dict.loc[target_dict['koi_id'] == KOI_ID]
 
-KIC = np.array(target_dict['kic_id'], dtype='int')[use]
-NPL = np.array(target_dict['npl'], dtype='int')[use]
+KIC = target_rows['kic_id'].to_numpy(dtype='int')
+NPL = target_rows['npl'].to_numpy(dtype='int')
 
-U1 = np.array(target_dict['limbdark_1'], dtype='float')[use]
-U2 = np.array(target_dict['limbdark_2'], dtype='float')[use]
+U1 = target_rows['limbdark_1'].to_numpy(dtype='float')
+U2 = target_rows['limbdark_2'].to_numpy(dtype='float')
 
-PERIODS = np.array(target_dict['period'], dtype='float')[use]
-EPOCHS  = np.array(target_dict['epoch'],  dtype='float')[use]
-DEPTHS  = np.array(target_dict['depth'], dtype='float')[use]*1e-6          # [ppm] --> []
-DURS    = np.array(target_dict['duration'], dtype='float')[use]/24         # [hrs] --> [days]
-IMPACTS = np.array(target_dict['impact'], dtype='float')[use]
+PERIODS = target_rows['period'].to_numpy(dtype='float')
+EPOCHS  = target_rows['epoch'].to_numpy(dtype='float')
+DEPTHS  = target_rows['depth'].to_numpy(dtype='float')*1e-6          # [ppm] --> []
+DURS    = target_rows['duration'].to_numpy(dtype='float')/24         # [hrs] --> [days]
+IMPACTS = target_rows['impact'].to_numpy(dtype='float')
 
 # do some consistency checks
 if all(k == KIC[0] for k in KIC): KIC = KIC[0]
@@ -192,6 +201,9 @@ else: raise ValueError("There are inconsistencies with U1 in the csv input file"
 if all(u == U2[0] for u in U2): U2 = U2[0]
 else: raise ValueError("There are inconsistencies with U2 in the csv input file")
 
+# limb-darkened stellar model shared by every transit model below
+starrystar = exo.LimbDarkLightCurve([U1,U2])
+
 if np.any(np.isnan(PERIODS)): raise ValueError("NaN values found in input catalog")
 if np.any(np.isnan(EPOCHS)):  raise ValueError("NaN values found in input catalog")
 if np.any(np.isnan(DEPTHS)):  raise ValueError("NaN values found in input catalog")
@@ -209,9 +221,9 @@ try:
         sc_path  = glob.glob(DOWNLOAD_DIR + 'mastDownload/Kepler/kplr' + '{0:09d}'.format(KIC) + '*_sc*/')[0]
         sc_files = glob.glob(sc_path + '*')
 
-        sc_rawdata_list = []
-        for i, scf in enumerate(sc_files):
-            sc_rawdata_list.append(lk.read(sc_files[i]))
+        # each file is parsed independently, so read them concurrently (order is preserved)
+        with ThreadPoolExecutor(max_workers=np.min([8, len(sc_files)])) as executor:
+            sc_rawdata_list = list(executor.map(lk.read, sc_files))
 
         sc_raw_collection = lk.LightCurveCollection(sc_rawdata_list)
         sc_data = io.cleanup_lkfc(sc_raw_collection, KIC)
@@ -221,9 +233,8 @@ try:
         sc_path = DOWNLOAD_DIR + 'Lightcurves/Kepler/simkplr' + '{0:09d}'.format(KIC) + '_sc/'
         sc_files = glob.glob(sc_path + '*')
 
-        sc_rawdata_list = []
-        for i, scf in enumerate(sc_files):
-            sc_rawdata_list.append(io.load_sim_fits(scf))
+        with ThreadPoolExecutor(max_workers=np.min([8, len(sc_files)])) as executor:
+            sc_rawdata_list = list(executor.map(io.load_sim_fits, sc_files))
 
         quarters = []
         for i, scrd in enumerate(sc_rawdata_list):
@@ -251,10 +262,11 @@ try:
         lc_path  = glob.glob(DOWNLOAD_DIR + 'mastDownload/Kepler/kplr' + '{0:09d}'.format(KIC) + '*_lc*/')[0]
         lc_files = glob.glob(lc_path + '*')
 
+        with ThreadPoolExecutor(max_workers=np.min([8, len(lc_files)])) as executor:
+            lc_lkread_list = list(executor.map(lk.read, lc_files))
+        
         lc_rawdata_list = []
-        for i, lcf in enumerate(lc_files):
-            lkread = lk.read(lc_files[i])
-
+        for i, lkread in enumerate(lc_lkread_list):
             if ~np.isin(lkread.quarter, sc_quarters):
                 lc_rawdata_list.append(lkread)
 
@@ -266,9 +278,8 @@ try:
         lc_path = DOWNLOAD_DIR + 'Lightcurves/Kepler/simkplr' + '{0:09d}'.format(KIC) + '_lc/'
         lc_files = glob.glob(lc_path + '*')
 
-        lc_rawdata_list = []
-        for i, lcf in enumerate(lc_files):
-            lc_rawdata_list.append(io.load_sim_fits(lcf))
+        with ThreadPoolExecutor(max_workers=np.min([8, len(lc_files)])) as executor:
+            lc_rawdata_list = list(executor.map(io.load_sim_fits, lc_files))
 
 
         quarters = []
@@ -333,14 +344,7 @@ if TIME_START < 0:
 
 
 # put epochs in range (TIME_START, TIME_START + PERIOD)
-for npl in range(NPL):
-    if EPOCHS[npl] < TIME_START:
-        adj = 1 + (TIME_START - EPOCHS[npl])//PERIODS[npl]
-        EPOCHS[npl] += adj*PERIODS[npl]        
-        
-    if EPOCHS[npl] > (TIME_START + PERIODS[npl]):
-        adj = (EPOCHS[npl] - TIME_START)//PERIODS[npl]
-        EPOCHS[npl] -= adj*PERIODS[npl]
+EPOCHS = TIME_START + np.mod(EPOCHS - TIME_START, PERIODS)
 
 
 # Initialize Planet objects
@@ -378,7 +382,7 @@ sorted_planets = []
 for npl in range(NPL):
     sorted_planets.append(planets[order[npl]])
 
-planets = np.copy(sorted_planets)
+planets = list(sorted_planets)
 
 
 ##########################
@@ -398,6 +402,9 @@ HOLCZER_FILE = PROJECT_DIR + 'Catalogs/holczer_2016_kepler_ttvs.txt'
 
 if MISSION == 'Kepler':
     holczer_data = np.loadtxt(HOLCZER_FILE, usecols=[0,1,2,3])
+    
+    # sort by KOI once (stable, so each KOI keeps its file order) for searchsorted lookups
+    holczer_data = holczer_data[np.argsort(holczer_data[:,0], kind='stable')]
 
     holczer_inds = []
     holczer_tts  = []
@@ -405,10 +412,14 @@ if MISSION == 'Kepler':
 
     for npl in range(NPL):
         koi = int(TARGET[1:]) + 0.01*(1+npl)
-        use = np.isclose(holczer_data[:,0], koi, rtol=1e-10, atol=1e-10)
+        tol = 1e-10 + 1e-10*koi
+        
+        lo = np.searchsorted(holczer_data[:,0], koi-tol, side='left')
+        hi = np.searchsorted(holczer_data[:,0], koi+tol, side='right')
+        use = slice(lo, hi)
         
         # Holczer uses BJD -24548900; BJKD = BJD - 2454833
-        if np.sum(use) > 0:
+        if hi > lo:
             holczer_inds.append(np.array(holczer_data[use,1], dtype='int'))
             holczer_tts.append(holczer_data[use,2] + holczer_data[use,3]/24/60 + 67)
             holczer_pers.append(np.median(holczer_tts[npl][1:] - holczer_tts[npl][:-1]))
@@ -443,13 +454,14 @@ if MISSION == 'Simulated':
         
         keep = np.zeros(len(tts_noisy), dtype='bool')
         
-        for i, t0 in enumerate(tts_noisy):
-            for j, scd in enumerate(sc_data):
-                if np.min(np.abs(scd.time - t0)) < p.duration:
-                    keep[i] = True
-            for j, lcd in enumerate(lc_data):
-                if np.min(np.abs(lcd.time - t0)) < p.duration:
-                    keep[i] = True
+        # time arrays are sorted, so the nearest cadence to each transit is one of its two searchsorted neighbors
+        for j, xcd in enumerate(sc_data + lc_data):
+            idx = np.searchsorted(xcd.time, tts_noisy)
+            lo  = np.clip(idx-1, 0, len(xcd.time)-1)
+            hi  = np.clip(idx, 0, len(xcd.time)-1)
+            
+            dist = np.minimum(np.abs(xcd.time[lo] - tts_noisy), np.abs(xcd.time[hi] - tts_noisy))
+            keep += dist < p.duration
         
         holczer_inds.append(inds[keep])
         holczer_tts.append(tts_noisy[keep])
@@ -464,20 +476,12 @@ if MISSION == 'Simulated':
 for npl in range(NPL):
     if np.isfinite(holczer_pers[npl]):
         # fit a linear ephemeris 
-        pfit  = poly.polyfit(holczer_inds[npl], holczer_tts[npl], 1)
-        ephem = poly.polyval(holczer_inds[npl], pfit)
+        ephem, pfit = linfit_eval(holczer_inds[npl], holczer_tts[npl], holczer_inds[npl])
         
         
         # put fitted epoch in range (TIME_START, TIME_START + PERIOD)
         hepoch, hper = pfit
-
-        if hepoch < TIME_START:
-            adj = 1 + (TIME_START - hepoch)//hper
-            hepoch += adj*hper       
-
-        if hepoch > (TIME_START + hper):
-            adj = (hepoch - TIME_START)//hper
-            hepoch -= adj*hper      
+        hepoch = TIME_START + np.mod(hepoch - TIME_START, hper)
 
         hephem = np.arange(hepoch, TIME_END, hper)        
         hinds  = np.array(np.round((hephem-hepoch)/hper),dtype='int')
@@ -492,16 +496,13 @@ for npl in range(NPL):
         
         
         # estimate TTV signal with a regularized Matern-3/2 GP
-        holczer_model = omc.matern32_model(xtime[~out], yomc[~out], hephem)
-
-        with holczer_model:
-            holczer_map = pmx.optimize()
+        holczer_map = omc.matern32_map(xtime[~out], yomc[~out], hephem)
 
 
         htts = hephem + holczer_map['pred']
 
-        holczer_inds[npl] = np.copy(hinds)
-        holczer_tts[npl] = np.copy(htts)
+        holczer_inds[npl] = hinds
+        holczer_tts[npl] = htts
 
         # plot the results
         plt.figure(figsize=(12,4))
@@ -530,16 +531,21 @@ for npl, p in enumerate(planets):
         htts  = holczer_tts[loc]
         
         # first update to Holczer ephemeris
-        epoch, period = poly.polyfit(hinds, htts, 1)
+        epoch, period = linfit(hinds, htts)
         
-        p.epoch = np.copy(epoch)
-        p.period = np.copy(period)
+        p.epoch = epoch
+        p.period = period
         p.tts = np.arange(p.epoch, TIME_END, p.period)
         
-        for i, t0 in enumerate(p.tts):
-            for j, tH in enumerate(htts):
-                if np.abs(t0-tH)/p.period < 0.25:
-                    p.tts[i] = tH
+        # snap to the nearest Holczer transit time (htts is sorted) if within a quarter period
+        idx = np.searchsorted(htts, p.tts)
+        lo  = np.clip(idx-1, 0, len(htts)-1)
+        hi  = np.clip(idx, 0, len(htts)-1)
+        
+        nearest = np.where(np.abs(p.tts-htts[lo]) < np.abs(p.tts-htts[hi]), htts[lo], htts[hi])
+        snap = np.abs(p.tts-nearest)/p.period < 0.25
+        
+        p.tts[snap] = nearest[snap]
 
     else:
         pass
@@ -550,7 +556,7 @@ fig, axes = plt.subplots(NPL, figsize=(12,3*NPL))
 if NPL == 1: axes = [axes]
 
 for npl, p in enumerate(planets):
-    xtime = poly.polyval(p.index, poly.polyfit(p.index, p.tts, 1))
+    xtime = p.epoch + p.index*p.period
     yomc  = (p.tts - xtime)*24*60
     
     axes[npl].plot(xtime, yomc, '.', c='C{0}'.format(npl))
@@ -568,8 +574,45 @@ if ~iplot: plt.close()
 print("\nDetrending lightcurves (1st pass)...\n")
 
 
+def detrend_quarter(litecurve, break_tolerance, min_period):
+    """
+    Detrend a single quarter, falling back to progressively simpler GP models if a fit fails
+    """
+    # only numerical failures trigger a fallback; anything else (e.g. KeyboardInterrupt, MemoryError) propagates
+    fit_errors = (np.linalg.LinAlgError, celerite2.driver.LinAlgError, ValueError, RuntimeError, FloatingPointError)
+    
+    try:
+        litecurve = detrend.flatten_with_gp(litecurve, break_tolerance, min_period)
+    except fit_errors as e:
+        warnings.warn("Initial detrending model failed ({0})...attempting to refit without exponential ramp component".format(e))
+        try:
+            litecurve = detrend.flatten_with_gp(litecurve, break_tolerance, min_period, correct_ramp=False)
+        except fit_errors as e:
+            warnings.warn("Detrending with RotationTerm failed ({0})...attempting to detrend with SHOTerm".format(e))
+            litecurve = detrend.flatten_with_gp(litecurve, break_tolerance, min_period, kterm='SHOTerm', correct_ramp=False)
+            
+    return litecurve
+
+
+def detrend_quarters(data, break_tolerance, min_period):
+    """
+    Detrend each quarter independently; quarters are spread over args.n_jobs forked worker processes
+    """
+    n_jobs = np.min([args.n_jobs, len(data)])
+    
+    if n_jobs <= 1:
+        return [detrend_quarter(d, break_tolerance, min_period) for d in data]
+    
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context('fork')) as executor:
+        return list(executor.map(detrend_quarter, data, [break_tolerance]*len(data), [min_period]*len(data)))
+
+
 # Detrend the lightcurves
 
+# transit mask windows depend only on the planets, not on the quarter
+all_tts = [p.tts for p in planets]
+masksizes = np.maximum(1/24, 1.5*np.array([p.duration for p in planets]))
+
 # long cadence data
 break_tolerance = np.max([int(DURS.min()/(LCIT/60/24)*5/2), 13])
 min_period = 1.0
@@ -581,24 +624,12 @@ for i, lcd in enumerate(lc_data):
     lcd.remove_flagged_cadences(qmask)
     
     # make transit mask
-    lcd.mask = np.zeros(len(lcd.time), dtype='bool')
-    for npl, p in enumerate(planets):
-        lcd.mask += detrend.make_transitmask(lcd.time, p.tts, np.max([1/24,1.5*p.duration]))
+    lcd.mask = detrend.make_transitmask_batched(lcd.time, all_tts, masksizes).any(axis=0)
     
-    lcd.clip_outliers(kernel_size=13, sigma_upper=5, sigma_lower=5, mask=lcd.mask)
-    lcd.clip_outliers(kernel_size=13, sigma_upper=5, sigma_lower=1000, mask=None)
+    lcd.clip_outliers(kernel_size=13, sigma_upper=5, sigma_lower=5, mask=lcd.mask, sigma_upper_all=5, sigma_lower_all=1000)
     
-    try:
-        lcd = detrend.flatten_with_gp(lcd, break_tolerance, min_period)
-    except:
-        warnings.warn("Initial detrending model failed...attempting to refit without exponential ramp component")
-        try:
-            lcd = detrend.flatten_with_gp(lcd, break_tolerance, min_period, correct_ramp=False)
-        except:
-            warnings.warn("Detrending with RotationTerm failed...attempting to detrend with SHOTerm")
-            lcd = detrend.flatten_with_gp(lcd, break_tolerance, min_period, kterm='SHOTerm', correct_ramp=False)
-            
-            
+lc_data = detrend_quarters(lc_data, break_tolerance, min_period)
+
 if len(lc_data) > 0:
     lc = detrend.stitch(lc_data)
 else:
@@ -615,24 +646,12 @@ for i, scd in enumerate(sc_data):
     scd.remove_flagged_cadences(qmask)
     
     # make transit mask
-    scd.mask = np.zeros(len(scd.time), dtype='bool')
-    for npl, p in enumerate(planets):
-        scd.mask += detrend.make_transitmask(scd.time, p.tts, np.max([1/24,1.5*p.duration]))
+    scd.mask = detrend.make_transitmask_batched(scd.time, all_tts, masksizes).any(axis=0)
     
-    scd.clip_outliers(kernel_size=13, sigma_upper=5, sigma_lower=5, mask=scd.mask)
-    scd.clip_outliers(kernel_size=13, sigma_upper=5, sigma_lower=1000, mask=None)
+    scd.clip_outliers(kernel_size=13, sigma_upper=5, sigma_lower=5, mask=scd.mask, sigma_upper_all=5, sigma_lower_all=1000)
     
-    try:
-        scd = detrend.flatten_with_gp(scd, break_tolerance, min_period)
-    except:
-        warnings.warn("Initial detrending model failed...attempting to refit without exponential ramp component")
-        try:
-            scd = detrend.flatten_with_gp(scd, break_tolerance, min_period, correct_ramp=False)
-        except:
-            warnings.warn("Detrending with RotationTerm failed...attempting to detrend with SHOTerm")
-            scd = detrend.flatten_with_gp(scd, break_tolerance, min_period, kterm='SHOTerm', correct_ramp=False)
-            
-            
+sc_data = detrend_quarters(sc_data, break_tolerance, min_period)
+
 if len(sc_data) > 0:
     sc = detrend.stitch(sc_data)
 else:
@@ -643,22 +662,20 @@ else:
 # These masks have width 2.5 transit durations, which is probably wider than the masks used for detrending
 
 if sc is not None:
-    sc_mask = np.zeros((NPL,len(sc.time)),dtype='bool')
-    for npl, p in enumerate(planets):
-        sc_mask[npl] = detrend.make_transitmask(sc.time, p.tts, np.max([2/24,2.5*p.duration]))
+    masksizes = [np.max([2/24,2.5*p.duration]) for p in planets]
+    sc_mask = detrend.make_transitmask_batched(sc.time, [p.tts for p in planets], masksizes)
         
-    sc.mask = sc_mask.sum(axis=0) > 0
+    sc.mask = sc_mask.any(axis=0)
 
 else:
     sc_mask = None
 
     
 if lc is not None:
-    lc_mask = np.zeros((NPL,len(lc.time)),dtype='bool')
-    for npl, p in enumerate(planets):
-        lc_mask[npl] = detrend.make_transitmask(lc.time, p.tts, np.max([2/24,2.5*p.duration]))
+    masksizes = [np.max([2/24,2.5*p.duration]) for p in planets]
+    lc_mask = detrend.make_transitmask_batched(lc.time, [p.tts for p in planets], masksizes)
         
-    lc.mask = lc_mask.sum(axis=0) > 0
+    lc.mask = lc_mask.any(axis=0)
 
 else:
     lc_mask = None
@@ -667,35 +684,38 @@ else:
 # Flag high quality transits (quality = 1)
 # Good transits must have  at least 50% photometry coverage in/near transit
 
+# bind the sorted-time search methods once for the window counts below
+sc_search = sc.time.searchsorted if sc is not None else None
+lc_search = lc.time.searchsorted if lc is not None else None
+
 for npl, p in enumerate(planets):
     count_expect_lc = int(np.ceil(p.duration/lcit))
     count_expect_sc = int(np.ceil(p.duration/scit))
         
     quality = np.zeros(len(p.tts), dtype='bool')
     
-    for i, t0 in enumerate(p.tts):
+    # time is sorted, so cadence counts within each window come from searchsorted bounds
+    if sc is not None:
+        in_sc = sc_search(p.tts+0.5*p.duration, 'left') - sc_search(p.tts-0.5*p.duration, 'right')
+        near_sc = sc_search(p.tts+1.5*p.duration, 'left') - sc_search(p.tts-1.5*p.duration, 'right')
         
-        if sc is not None:
-            in_sc = np.abs(sc.time - t0)/p.duration < 0.5
-            near_sc = np.abs(sc.time - t0)/p.duration < 1.5
-            
-            qual_in = np.sum(in_sc) > 0.5*count_expect_sc
-            qual_near = np.sum(near_sc) > 1.5*count_expect_sc
-            
-            quality[i] += qual_in*qual_near
+        qual_in = in_sc > 0.5*count_expect_sc
+        qual_near = near_sc > 1.5*count_expect_sc
+        
+        quality += qual_in*qual_near
+    
+    
+    if lc is not None:
+        in_lc = lc_search(p.tts+0.5*p.duration, 'left') - lc_search(p.tts-0.5*p.duration, 'right')
+        near_lc = lc_search(p.tts+1.5*p.duration, 'left') - lc_search(p.tts-1.5*p.duration, 'right')
         
+        qual_in = in_lc > 0.5*count_expect_lc
+        qual_near = near_lc > 1.5*count_expect_lc
+        
+        quality += qual_in*qual_near
         
-        if lc is not None:
-            in_lc = np.abs(lc.time - t0)/p.duration < 0.5
-            near_lc = np.abs(lc.time - t0)/p.duration < 1.5
-            
-            qual_in = np.sum(in_lc) > 0.5*count_expect_lc
-            qual_near = np.sum(near_lc) > 1.5*count_expect_lc
-            
-            quality[i] += qual_in*qual_near
-            
     
-    p.quality = np.copy(quality)
+    p.quality = quality
 
 
 # Identify overlapping transits
@@ -703,14 +723,15 @@ dur_max = np.max(DURS)
 overlap = []
 
 for i in range(NPL):
-    overlap.append(np.zeros(len(planets[i].tts), dtype='bool'))
+    # a transit overlaps if any other planet transits within 1.5 max durations
+    others = np.sort(np.concatenate([planets[j].tts for j in range(NPL) if j != i] + [np.array([])]))
+    
+    lo = np.searchsorted(others, planets[i].tts - 1.5*dur_max, 'right')
+    hi = np.searchsorted(others, planets[i].tts + 1.5*dur_max, 'left')
     
-    for j in range(NPL):
-        if i != j:
-            for ttj in planets[j].tts:
-                overlap[i] += np.abs(planets[i].tts - ttj)/dur_max < 1.5
+    overlap.append(hi > lo)
                 
-    planets[i].overlap = np.copy(overlap[i])
+    planets[i].overlap = overlap[i]
 
 
 # Count up transits and calculate initial fixed transit times
@@ -735,13 +756,22 @@ all_dtype = ['none']*18
 lc_flux = []
 sc_flux = []
 
+# quarters are stitched in increasing order, so each one is a contiguous [lo, hi) range of cadences
+if sc is not None:
+    sc_qbounds = np.searchsorted(sc.quarter, np.arange(19))
+    
+if lc is not None:
+    lc_qbounds = np.searchsorted(lc.quarter, np.arange(19))
+
 
 for q in range(18):
     if sc is not None:
-        if np.isin(q, sc.quarter):
-            use = (sc.mask)*(sc.quarter == q)
+        lo, hi = sc_qbounds[q], sc_qbounds[q+1]
+        
+        if hi > lo:
+            use = lo + np.flatnonzero(sc.mask[lo:hi])
 
-            if np.sum(use) > 45:
+            if len(use) > 45:
                 all_time[q] = sc.time[use]
                 all_flux[q] = sc.flux[use]
                 all_error[q] = sc.error[use]
@@ -754,10 +784,12 @@ for q in range(18):
 
     
     if lc is not None:
-        if np.isin(q, lc.quarter):
-            use = (lc.mask)*(lc.quarter == q)
+        lo, hi = lc_qbounds[q], lc_qbounds[q+1]
+        
+        if hi > lo:
+            use = lo + np.flatnonzero(lc.mask[lo:hi])
 
-            if np.sum(use) > 5:
+            if len(use) > 5:
                 all_time[q] = lc.time[use]
                 all_flux[q] = lc.flux[use]
                 all_error[q] = lc.error[use]
@@ -771,36 +803,28 @@ for q in range(18):
                 
                 
 # check which quarters have coverage
-good = (np.array(all_dtype) == 'short') + (np.array(all_dtype) == 'long')
+dtype_arr = np.array(all_dtype)
+is_short  = dtype_arr == 'short'
+is_long   = dtype_arr == 'long'
+
+good = is_short + is_long
 quarters = np.arange(18)[good]
 nq = len(quarters)
 
 
-# make some linear flux arrays (for convenience use laster)
-try: sc_flux_lin = np.hstack(sc_flux)
-except: sc_flux_lin = np.array([])
-    
-try: lc_flux_lin = np.hstack(lc_flux)
-except: lc_flux_lin = np.array([])
-    
-try:
-    good_flux = np.hstack([sc_flux_lin, lc_flux_lin])
-except:
-    try:
-        good_flux = np.hstack(sc_flux)
-    except:
-        good_flux = np.hstack(lc_flux)
+# make a linear flux array of all quarters with transits (single concatenation)
+good_flux = np.concatenate(sc_flux + lc_flux)
         
         
 # set oversampling factors and expoure times
 oversample = np.zeros(18, dtype='int')
 texp = np.zeros(18)
 
-oversample[np.array(all_dtype)=='short'] = 1
-oversample[np.array(all_dtype)=='long'] = 15
+oversample[is_short] = 1
+oversample[is_long] = 15
 
-texp[np.array(all_dtype)=='short'] = scit
-texp[np.array(all_dtype)=='long'] = lcit
+texp[is_short] = scit
+texp[is_long] = lcit
 
 
 # Pull basic transit parameters
@@ -831,10 +855,13 @@ for npl, p in enumerate(planets):
     t.append(p.epoch + transit_inds[npl]*p.period)
     x = 2*(t[npl]-TIME_START)/(TIME_END-TIME_START) - 1
 
-    Leg0.append(np.ones_like(x))
-    Leg1.append(x.copy())
-    Leg2.append(0.5*(3*x**2 - 1))
-    Leg3.append(0.5*(5*x**3 - 3*x))
+    # rows of the transposed Vandermonde matrix are contiguous P0(x)...P3(x)
+    V = np.polynomial.legendre.legvander(x, 3).T.copy()
+
+    Leg0.append(V[0])
+    Leg1.append(V[1])
+    Leg2.append(V[2])
+    Leg3.append(V[3])
 
 print("")
 print("cumulative runtime = ", int(timer() - global_start_time), "s")
@@ -867,8 +894,7 @@ with pm.Model() as shape_model:
                                               fixed_tts[npl] + C0[npl]*Leg0[npl] + C1[npl]*Leg1[npl]))
     
     
-    # set up stellar model and planetary orbit
-    starrystar = exo.LimbDarkLightCurve([U1,U2])
+    # set up planetary orbit
     orbit = exo.orbits.TTVOrbit(transit_times=transit_times, transit_inds=transit_inds, 
                                 b=b, ror=r, duration=dur)
     
@@ -877,9 +903,12 @@ with pm.Model() as shape_model:
     P  = pm.Deterministic('P', orbit.period)
     
     
-    # nuissance parameters
-    flux0 = pm.Normal('flux0', mu=np.mean(good_flux), sd=np.std(good_flux), shape=len(quarters))
-    log_jit = pm.Normal('log_jit', mu=np.log(np.var(good_flux)/10), sd=10, shape=len(quarters))
+    # nuissance parameters (initialized from per-quarter flux statistics)
+    flux0_init = np.array([np.mean(all_flux[q]) for q in quarters])
+    log_jit_init = np.log([np.var(all_flux[q])/10 for q in quarters])
+    
+    flux0 = pm.Normal('flux0', mu=np.mean(good_flux), sd=np.std(good_flux), shape=len(quarters), testval=flux0_init)
+    log_jit = pm.Normal('log_jit', mu=np.log(np.var(good_flux)/10), sd=10, shape=len(quarters), testval=log_jit_init)
     
 
     # now evaluate the model for each quarter
@@ -893,7 +922,7 @@ with pm.Model() as shape_model:
         light_curves[j] = starrystar.get_light_curve(orbit=orbit, r=r, t=all_time[q], 
                                                      oversample=oversample[j], texp=texp[j])
         
-        model_flux[j] = pm.math.sum(light_curves[j], axis=-1) + flux0[j]*T.ones(len(all_time[q]))
+        model_flux[j] = pm.math.sum(light_curves[j], axis=-1) + flux0[j]
         flux_err[j] = T.sqrt(np.mean(all_error[q])**2 + T.exp(log_jit[j]))/np.sqrt(2)
         
         obs[j] = pm.Normal('obs_{0}'.format(j), 
@@ -905,7 +934,6 @@ with pm.Model() as shape_model:
 # find maximum a posteriori (MAP) solution
 with shape_model:
     shape_map = shape_model.test_point
-    shape_map = pmx.optimize(start=shape_map, vars=[flux0, log_jit])
     shape_map = pmx.optimize(start=shape_map, vars=[b, r, dur])
     shape_map = pmx.optimize(start=shape_map, vars=[C0, C1])
     shape_map = pmx.optimize(start=shape_map)
@@ -945,8 +973,24 @@ print('\nFitting TTVs..\n')
 slide_transit_times = []
 slide_error = []
 
-t_all = np.array(np.hstack(all_time), dtype='float')
-f_all = np.array(np.hstack(all_flux), dtype='float')
+# concatenate only the quarters with data; quarters are in time order, so the result is normally already sorted
+t_all = np.ascontiguousarray(np.concatenate([all_time[q] for q in quarters]), dtype='float')
+f_all = np.ascontiguousarray(np.concatenate([all_flux[q] for q in quarters]), dtype='float')
+
+# data near each transit is sliced out with searchsorted, which requires sorted times
+if np.any(np.diff(t_all) < 0):
+    order = np.argsort(t_all, kind='stable')
+    t_all = t_all[order]
+    f_all = f_all[order]
+
+# compile the template transit model once; it is evaluated for each planet below
+template_period, template_b, template_ror, template_dur = [T.dscalar() for i in range(4)]
+template_tgrid = T.dvector()
+
+orbit = exo.orbits.KeplerianOrbit(t0=0, period=template_period, b=template_b, ror=template_ror, duration=template_dur)
+
+template_fxn = theano.function([template_period, template_b, template_ror, template_dur, template_tgrid],
+                               1.0 + starrystar.get_light_curve(orbit=orbit, r=template_ror, t=template_tgrid).sum(axis=-1))
 
 for npl, p in enumerate(planets):
     print("\nPLANET", npl)
@@ -955,64 +999,58 @@ for npl, p in enumerate(planets):
     slide_error.append([])
     
     # create template transit
-    starrystar = exo.LimbDarkLightCurve([U1,U2])
-    orbit  = exo.orbits.KeplerianOrbit(t0=0, period=p.period, b=p.impact, ror=rors[npl], duration=p.duration)
-
     gridstep     = scit/2
     slide_offset = 1.0
     delta_chisq  = 2.0
 
     template_time = np.arange(-(0.02+p.duration)*(slide_offset+1.6), (0.02+p.duration)*(slide_offset+1.6), gridstep)
-    template_flux = 1.0 + starrystar.get_light_curve(orbit=orbit, r=rors[npl], t=template_time).sum(axis=-1).eval()
+    template_flux = template_fxn(p.period, p.impact, rors[npl], p.duration, template_time)
     
     # empty lists to hold new transit time and uncertainties
     tts = -99*np.ones_like(shape_transit_times[npl])
     err = -99*np.ones_like(shape_transit_times[npl])
     
+    # non-overlapping flags for each good-quality transit, evaluated once per planet
+    no_overlap = ~p.overlap[p.quality]
+    
     for i, t0 in enumerate(shape_transit_times[npl]):
         #print(i, np.round(t0,2))
-        if ~p.overlap[p.quality][i]:
+        if no_overlap[i]:
         
             # grab flux near each non-overlapping transit
-            use = np.abs(t_all - t0)/p.duration < 2.5
-            mask = np.abs(t_all - t0)/p.duration < 1.0
+            lo = np.searchsorted(t_all, t0 - 2.5*p.duration, side='right')
+            hi = np.searchsorted(t_all, t0 + 2.5*p.duration, side='left')
 
-            t_ = t_all[use]
-            f_ = f_all[use]
-            m_ = mask[use]
+            t_ = t_all[lo:hi]
+            f_ = f_all[lo:hi]
+            m_ = np.abs(t_ - t0)/p.duration < 1.0
             
             # remove any residual out-of-transit trend
-            try:
-                trend = poly.polyval(t_, poly.polyfit(t_[~m_], f_[~m_], 1))
+            if np.sum(~m_) >= 2:
+                trend, _ = linfit_eval(t_[~m_], f_[~m_], t_)
             
-                f_ /= trend
-                e_ = np.ones_like(f_)*np.std(f_[~m_])
+                f_ = f_/trend
+                e_ = np.std(f_[~m_])
                 
-            except:
-                e_ = np.ones_like(f_)*np.std(f_)
+            else:
+                e_ = np.std(f_)
             
             # slide along transit time vector and calculate chisq
             tc_vector = t0 + np.arange(-p.duration*slide_offset, p.duration*slide_offset, gridstep)
-            chisq_vector = np.zeros_like(tc_vector)
-
-            for j, tc in enumerate(tc_vector):
-                y_ = np.interp(t_-tc, template_time, template_flux)
-                chisq_vector[j] = np.sum((f_ - y_)**2/e_**2)
+            chisq_vector = slide_chisq(t_, f_, e_, template_time, template_flux, tc_vector)
 
-            chisq_vector = boxcar_smooth(chisq_vector, winsize=7)
+            # 7-point boxcar smoothing (reflected edges) as a single windowed mean
+            chisq_vector = sliding_window_view(np.pad(chisq_vector, 3, mode='reflect'), 7).mean(axis=-1)
 
-            # grab points near minimum chisq
-            delta_chisq = 1
+            # grab points near minimum chisq, widening delta_chisq until at least 3 points remain
+            min_chisq = chisq_vector.min()
             
-            loop = True
-            while loop:
-                # incrememnt delta_chisq and find minimum
-                delta_chisq += 1
-                min_chisq = chisq_vector.min()
-                
+            for delta_chisq in range(2,10):
                 # grab the points near minimum
-                tcfit = tc_vector[chisq_vector < min_chisq+delta_chisq]
-                x2fit = chisq_vector[chisq_vector < min_chisq+delta_chisq]
+                near = chisq_vector < min_chisq+delta_chisq
+                
+                tcfit = tc_vector[near]
+                x2fit = chisq_vector[near]
 
                 # eliminate points far from the local minimum
                 spacing = np.median(tcfit[1:]-tcfit[:-1])
@@ -1021,12 +1059,9 @@ for npl, p in enumerate(planets):
                 tcfit = tcfit[~faraway]
                 x2fit = x2fit[~faraway]
                 
-                # check for stopping conditions
+                # check for stopping condition
                 if len(x2fit) >= 3:
-                    loop = False
-                    
-                if delta_chisq >= 9:
-                    loop = False
+                    break
                     
             # fit a parabola around the minimum (need at least 3 pts)
             if len(tcfit) < 3:
@@ -1035,10 +1070,15 @@ for npl, p in enumerate(planets):
                 err[i] = np.nan
 
             else:
-                quad_coeffs = np.polyfit(tcfit, x2fit, 2)
-                quadfit = np.polyval(quad_coeffs, tcfit)
-                qtc_min = -quad_coeffs[1]/(2*quad_coeffs[0])
-                qx2_min = np.polyval(quad_coeffs, qtc_min)
+                # least squares via the 3x3 normal equations, centered and scaled for conditioning
+                tc_mid = np.mean(tcfit)
+                u = (tcfit - tc_mid)/gridstep
+                V = np.vander(u, 3)
+                
+                quad_coeffs = np.linalg.solve(V.T @ V, V.T @ x2fit)
+                quad_coeffs = quad_coeffs/np.array([gridstep**2, gridstep, 1.0])
+                
+                qtc_min = tc_mid - quad_coeffs[1]/(2*quad_coeffs[0])
                 qtc_err = np.sqrt(1/quad_coeffs[0])
 
                 # here's the fitted transit time
@@ -1069,6 +1109,8 @@ for npl, p in enumerate(planets):
                     ax[0].plot(template_time, template_flux, c='C{0}'.format(npl), lw=2)
 
                     ax[1].plot(tcfit, x2fit, 'ko')
+                    quadfit = np.polyval(quad_coeffs, tcfit - tc_mid)
+                    
                     ax[1].plot(tcfit, quadfit, c='C{0}'.format(npl), lw=3)
                     ax[1].axvline(tts[i], color='k', ls='--', lw=2)
                     
@@ -1108,7 +1150,7 @@ fig, axes = plt.subplots(NPL, figsize=(12,3*NPL))
 if NPL == 1: axes = [axes]
 
 for npl, p in enumerate(planets):
-    ephem = poly.polyval(transit_inds[npl], poly.polyfit(transit_inds[npl], slide_transit_times[npl], 1))
+    ephem, _ = linfit_eval(transit_inds[npl], slide_transit_times[npl], transit_inds[npl])
     
     xtime = slide_transit_times[npl]
     yomc  = (slide_transit_times[npl] - ephem)*24*60
@@ -1133,24 +1175,20 @@ print("")
 # Fit MAP INDEPENDENT TTVs (only refit transits for which the cross-correlation method failed)
 
 if sc is not None:
-    sc_map_mask = np.zeros((NPL,len(sc.time)),dtype='bool')
-    for npl, p in enumerate(planets):
-        tts = slide_transit_times[npl][refit[npl]]
-        sc_map_mask[npl] = detrend.make_transitmask(sc.time, tts, np.max([2/24,2.5*p.duration]))
-        
-    sc_map_mask = sc_map_mask.sum(axis=0) > 0
+    masksizes = [np.max([2/24,2.5*p.duration]) for p in planets]
+    refit_tts = [slide_transit_times[npl][refit[npl]] for npl in range(NPL)]
+    
+    sc_map_mask = detrend.make_transitmask_batched(sc.time, refit_tts, masksizes).any(axis=0)
 
 else:
     sc_map_mask = None
 
     
 if lc is not None:
-    lc_map_mask = np.zeros((NPL,len(lc.time)),dtype='bool')
-    for npl, p in enumerate(planets):
-        tts = slide_transit_times[npl][refit[npl]]
-        lc_map_mask[npl] = detrend.make_transitmask(lc.time, tts, np.max([2/24,2.5*p.duration]))
-        
-    lc_map_mask = lc_map_mask.sum(axis=0) > 0
+    masksizes = [np.max([2/24,2.5*p.duration]) for p in planets]
+    refit_tts = [slide_transit_times[npl][refit[npl]] for npl in range(NPL)]
+    
+    lc_map_mask = detrend.make_transitmask_batched(lc.time, refit_tts, masksizes).any(axis=0)
 
 else:
     lc_map_mask = None
@@ -1164,10 +1202,12 @@ map_dtype = ['none']*18
 
 for q in range(18):
     if sc is not None:
-        if np.isin(q, sc.quarter):
-            use = (sc_map_mask)*(sc.quarter == q)
+        lo, hi = sc_qbounds[q], sc_qbounds[q+1]
+        
+        if hi > lo:
+            use = lo + np.flatnonzero(sc_map_mask[lo:hi])
 
-            if np.sum(use) > 45:
+            if len(use) > 45:
                 map_time[q] = sc.time[use]
                 map_flux[q] = sc.flux[use]
                 map_error[q] = sc.error[use]
@@ -1178,10 +1218,12 @@ for q in range(18):
 
     
     if lc is not None:
-        if np.isin(q, lc.quarter):
-            use = (lc_map_mask)*(lc.quarter == q)
+        lo, hi = lc_qbounds[q], lc_qbounds[q+1]
+        
+        if hi > lo:
+            use = lo + np.flatnonzero(lc_map_mask[lo:hi])
 
-            if np.sum(use) > 5:
+            if len(use) > 5:
                 map_time[q] = lc.time[use]
                 map_flux[q] = lc.flux[use]
                 map_error[q] = lc.error[use]
@@ -1209,8 +1251,7 @@ with pm.Model() as indep_model:
         
         map_inds.append(transit_inds[npl][use])
         
-    # set up stellar model and planetary orbit
-    starrystar = exo.LimbDarkLightCurve([U1,U2])
+    # set up planetary orbit
     orbit  = exo.orbits.TTVOrbit(transit_times=map_tts, transit_inds=map_inds, 
                                  period=periods, b=impacts, ror=rors, duration=durs)
     
@@ -1229,7 +1270,7 @@ with pm.Model() as indep_model:
         light_curves[j] = starrystar.get_light_curve(orbit=orbit, r=rors, t=map_time[q], 
                                                      oversample=oversample[j], texp=texp[j])
         
-        model_flux[j] = pm.math.sum(light_curves[j], axis=-1) + flux0[j]*T.ones(len(map_time[q]))
+        model_flux[j] = pm.math.sum(light_curves[j], axis=-1) + flux0[j]
         flux_err[j] = T.sqrt(np.mean(map_error[q])**2 + T.exp(log_jit[j]))/np.sqrt(2)
         
         obs[j] = pm.Normal('obs_{0}'.format(j), 
@@ -1261,10 +1302,10 @@ for npl, p in enumerate(planets):
     if np.any(replace):
         indep_transit_times[npl][replace] = indep_map['tts_{0}'.format(npl)]
 
-    pfit = poly.polyfit(transit_inds[npl], indep_transit_times[npl], 1)
+    ephem, (epoch, period) = linfit_eval(transit_inds[npl], indep_transit_times[npl], transit_inds[npl])
 
-    indep_ephemeris.append(poly.polyval(transit_inds[npl], pfit))
-    full_indep_ephemeris.append(poly.polyval(p.index, pfit))
+    indep_ephemeris.append(ephem)
+    full_indep_ephemeris.append(epoch + period*p.index)
 
     if np.any(replace):
         indep_error[npl][replace] = np.std(indep_transit_times[npl] - indep_ephemeris[npl])
@@ -1441,12 +1482,12 @@ for npl, p in enumerate(planets):
         elif polyorder >= 1:
             omc_model = omc.poly_model(xtime[~out], yomc[~out], polyorder, xtime)
 
+        # model comparison only needs residuals at the MAP; the selected model is sampled below
         with omc_model:
             omc_map = omc_model.test_point
             omc_map = pmx.optimize(start=omc_map)
-            omc_trace = pmx.sample(tune=8000, draws=2000, start=omc_map, chains=2, target_accept=0.95)
 
-        omc_trend = np.nanmedian(omc_trace['pred'], 0)
+        omc_trend = omc_map['pred']
         residuals = yomc - omc_trend
 
         plt.figure(figsize=(12,3))
@@ -1461,7 +1502,7 @@ for npl, p in enumerate(planets):
         mix_model = omc.mix_model(residuals)
 
         with mix_model:
-            mix_trace = pmx.sample(tune=8000, draws=2000, chains=1, target_accept=0.95)
+            mix_trace = pmx.sample(tune=1000, draws=500, chains=1, target_accept=0.95)
 
         loc = np.nanmedian(mix_trace['mu'], axis=0)
         scales = np.nanmedian(1/np.sqrt(mix_trace['tau']), axis=0)
@@ -1573,10 +1614,10 @@ for npl in range(NPL):
 # Update and save TTVs
 for npl, p in enumerate(planets):
     # update transit time info in Planet objects
-    epoch, period = poly.polyfit(p.index, full_quick_transit_times[npl], 1)
+    epoch, period = linfit(p.index, full_quick_transit_times[npl])
 
-    p.epoch = np.copy(epoch)
-    p.period = np.copy(period)
+    p.epoch = epoch
+    p.period = period
     p.tts = np.copy(full_quick_transit_times[npl])
     
     # save transit timing info to output file
@@ -1597,6 +1638,37 @@ print("")
 # cadences must be flagged as outliers from *both* the QUICK ttv model and the INDEPENDENT ttv model to be rejected
 print("\nFlagging outliers based on transit model...\n")
 
+# compile each transit model once and reuse it for every quarter with the same planets and cadence type
+lc_fxn_cache = {}
+
+def get_lc_fxn(wp, dtype):
+    key = (tuple(wp), dtype)
+    
+    if key not in lc_fxn_cache:
+        tts_symbol  = [T.dvector() for npl in wp]
+        inds_symbol = [T.lvector() for npl in wp]
+        t_symbol    = T.dvector()
+        
+        # set oversampling factor
+        if dtype == 'short':
+            oversample = 1
+            texp = scit
+        elif dtype == 'long':
+            oversample = 15
+            texp = lcit
+        
+        # set up model
+        orbit  = exo.orbits.TTVOrbit(transit_times=tts_symbol, transit_inds=inds_symbol, period=list(periods[wp]), 
+                                     b=impacts[wp], ror=rors[wp], duration=durs[wp])
+        
+        # calculate light curves
+        light_curves = starrystar.get_light_curve(orbit=orbit, r=rors[wp], t=t_symbol, oversample=oversample, texp=texp)
+        
+        lc_fxn_cache[key] = theano.function(tts_symbol + inds_symbol + [t_symbol], 1.0 + pm.math.sum(light_curves, axis=-1))
+    
+    return lc_fxn_cache[key]
+
+
 res_i = []
 res_q = []
 
@@ -1644,22 +1716,8 @@ for j, q in enumerate(quarters):
     
     # first check independent transit times
     if len(tts_i) > 0:
-        # set up model
-        starrystar = exo.LimbDarkLightCurve([U1,U2])
-        orbit  = exo.orbits.TTVOrbit(transit_times=tts_i, transit_inds=inds_i, period=list(periods[wp_i]), 
-                                     b=impacts[wp_i], ror=rors[wp_i], duration=durs[wp_i])
-
-        # set oversampling factor
-        if all_dtype[q] == 'short':
-            oversample = 1
-            texp = scit
-        elif all_dtype[q] == 'long':
-            oversample = 15
-            texp = lcit
-
-        # calculate light curves
-        light_curves = starrystar.get_light_curve(orbit=orbit, r=rors[wp_i], t=t_, oversample=oversample, texp=texp)
-        model_flux = 1.0 + pm.math.sum(light_curves, axis=-1).eval()
+        lc_fxn = get_lc_fxn(wp_i, all_dtype[q])
+        model_flux = lc_fxn(*tts_i, *inds_i, t_)
 
     else:
         model_flux = np.ones_like(f_)*np.mean(f_)
@@ -1670,22 +1728,8 @@ for j, q in enumerate(quarters):
     
     # then check matern transit times
     if len(tts_q) > 0:
-        # set up model
-        starrystar = exo.LimbDarkLightCurve([U1,U2])
-        orbit  = exo.orbits.TTVOrbit(transit_times=tts_q, transit_inds=inds_q, period=list(periods[wp_q]), 
-                                     b=impacts[wp_q], ror=rors[wp_q], duration=durs[wp_q])
-
-        # set oversampling factor
-        if all_dtype[q] == 'short':
-            oversample = 1
-            texp = scit*1.0
-        elif all_dtype[q] == 'long':
-            oversample = 15
-            texp = lcit*1.0
-
-        # calculate light curves
-        light_curves = starrystar.get_light_curve(orbit=orbit, r=rors[wp_q], t=t_, oversample=oversample, texp=texp)
-        model_flux = 1.0 + pm.math.sum(light_curves, axis=-1).eval()
+        lc_fxn = get_lc_fxn(wp_q, all_dtype[q])
+        model_flux = lc_fxn(*tts_q, *inds_q, t_)
 
     else:
         model_flux = np.ones_like(f_)*np.mean(f_)
@@ -1693,53 +1737,54 @@ for j, q in enumerate(quarters):
     # calculate residuals
     res_q.append(f_ - model_flux)
 
+# flag outliers in each quarter once; the flags are reused when assembling the cadence masks below
+bad_i_list = []
+bad_q_list = []
+
 for j, q in enumerate(quarters):
     print("\nQUARTER", q)
-    res = 0.5*(res_i[j] + res_q[j])
-    x_ = np.arange(len(res))
     
     bad_i = np.abs(res_i[j] - np.mean(res_i[j]))/astropy.stats.mad_std(res_i[j]) > 5.0
     bad_q = np.abs(res_q[j] - np.mean(res_q[j]))/astropy.stats.mad_std(res_q[j]) > 5.0
     
+    bad_i_list.append(bad_i)
+    bad_q_list.append(bad_q)
+    
     bad = bad_i * bad_q
     
     print(" outliers rejected:", np.sum(bad))
     print(" marginal outliers:", np.sum(bad_i*~bad_q)+np.sum(~bad_i*bad_q))
 
-bad_lc = []
-bad_sc = []
+# fill outlier flags in place using the per-quarter cadence ranges computed above
+if lc is not None:
+    bad_lc = np.zeros(len(lc.time), dtype='bool')
+else:
+    bad_lc = np.zeros(0, dtype='bool')
+    
+if sc is not None:
+    bad_sc = np.zeros(len(sc.time), dtype='bool')
+else:
+    bad_sc = np.zeros(0, dtype='bool')
 
 for q in range(18):
     if all_dtype[q] == 'long_no_transits':
-        bad = np.ones(np.sum(lc.quarter == q), dtype='bool')
-        bad_lc = np.hstack([bad_lc, bad])
+        bad_lc[lc_qbounds[q]:lc_qbounds[q+1]] = True
         
         
     if all_dtype[q] == 'short_no_transits':
-        bad = np.ones(np.sum(sc.quarter == q), dtype='bool')
-        bad_sc = np.hstack([bad_sc, bad])    
+        bad_sc[sc_qbounds[q]:sc_qbounds[q+1]] = True
     
     
     if (all_dtype[q] == 'short') + (all_dtype[q] == 'long'):
         j = np.where(quarters == q)[0][0]
 
-        res = 0.5*(res_i[j] + res_q[j])
-        x_ = np.arange(len(res))
-
-        bad_i = np.abs(res_i[j] - np.mean(res_i[j]))/astropy.stats.mad_std(res_i[j]) > 5.0
-        bad_q = np.abs(res_q[j] - np.mean(res_q[j]))/astropy.stats.mad_std(res_q[j]) > 5.0
-
-        bad = bad_i * bad_q
+        bad = bad_i_list[j] * bad_q_list[j]
 
         if all_dtype[q] == 'short':
-            bad_sc = np.hstack([bad_sc, bad])
+            bad_sc[sc_qbounds[q]:sc_qbounds[q+1]] = bad
 
         if all_dtype[q] == 'long':
-            bad_lc = np.hstack([bad_lc, bad])
-        
-        
-bad_lc = np.array(bad_lc, dtype='bool')
-bad_sc = np.array(bad_sc, dtype='bool')
+            bad_lc[lc_qbounds[q]:lc_qbounds[q+1]] = bad
 
 
 if sc is not None:
@@ -1812,6 +1857,10 @@ for i, lcl in enumerate(lc_lite):
         lc_data.append(lcl.remove_flagged_cadences(qmask))
 
 
+# transit mask windows depend only on the planets, not on the quarter
+all_tts = [p.tts for p in planets]
+masksizes = np.maximum(1/24, 0.5*np.array([p.duration for p in planets]) + ttv_buffer)
+
 # detrend long cadence data
 break_tolerance = np.max([int(DURS.min()/(LCIT/60/24)*5/2), 13])
 min_period = 1.0
@@ -1820,23 +1869,16 @@ for i, lcd in enumerate(lc_data):
     print("QUARTER {}".format(lcd.quarter[0]))
     
     # make transit mask
-    lcd.mask = np.zeros(len(lcd.time), dtype='bool')
-    for npl, p in enumerate(planets):
-        masksize = np.max([1/24, 0.5*p.duration + ttv_buffer[npl]])
-        lcd.mask += detrend.make_transitmask(lcd.time, p.tts, masksize)
+    lcd.mask = detrend.make_transitmask_batched(lcd.time, all_tts, masksizes).any(axis=0)
     
-    try:
-        lcd = detrend.flatten_with_gp(lcd, break_tolerance, min_period)
-    except:
-        warnings.warn("Initial detrending model failed...attempting to refit without exponential ramp component")
-        try:
-            lcd = detrend.flatten_with_gp(lcd, break_tolerance, min_period, correct_ramp=False)
-        except:
-            warnings.warn("Detrending with RotationTerm failed...attempting to detrend with SHOTerm")
-            lcd = detrend.flatten_with_gp(lcd, break_tolerance, min_period, kterm="SHOTerm", correct_ramp=False) 
-            
+lc_data = detrend_quarters(lc_data, break_tolerance, min_period)
+
 if len(lc_data) > 0:
     lc = detrend.stitch(lc_data)
+    
+    # detrended flux is written and loaded as float32; time keeps full precision
+    lc.flux  = lc.flux.astype('float32')
+    lc.error = lc.error.astype('float32')
 else:
     lc = None
 
@@ -1848,23 +1890,16 @@ for i, scd in enumerate(sc_data):
     print("QUARTER {}".format(scd.quarter[0]))
     
     # make transit mask
-    scd.mask = np.zeros(len(scd.time), dtype='bool')
-    for npl, p in enumerate(planets):
-        masksize = np.max([1/24, 0.5*p.duration + ttv_buffer[npl]])
-        scd.mask += detrend.make_transitmask(scd.time, p.tts, masksize)
+    scd.mask = detrend.make_transitmask_batched(scd.time, all_tts, masksizes).any(axis=0)
     
-    try:
-        scd = detrend.flatten_with_gp(scd, break_tolerance, min_period)
-    except:
-        warnings.warn("Initial detrending model failed...attempting to refit without exponential ramp component")
-        try:
-            scd = detrend.flatten_with_gp(scd, break_tolerance, min_period, correct_ramp=False)
-        except:
-            warnings.warn("Detrending with RotationTerm failed...attempting to detrend with SHOTerm")
-            scd = detrend.flatten_with_gp(scd, break_tolerance, min_period, kterm="SHOTerm", correct_ramp=False)
-            
+sc_data = detrend_quarters(sc_data, break_tolerance, min_period)
+
 if len(sc_data) > 0:
     sc = detrend.stitch(sc_data)
+    
+    # detrended flux is written and loaded as float32; time keeps full precision
+    sc.flux  = sc.flux.astype('float32')
+    sc.error = sc.error.astype('float32')
 else:
     sc = None
 
@@ -1877,22 +1912,20 @@ else:
 # these masks have width 1.5 transit durations, which may be wider than the masks used for detrending
 
 if sc is not None:
-    sc_mask = np.zeros((NPL,len(sc.time)),dtype='bool')
-    for npl, p in enumerate(planets):
-        sc_mask[npl] = detrend.make_transitmask(sc.time, p.tts, np.max([3/24,1.5*p.duration]))
+    masksizes = [np.max([3/24,1.5*p.duration]) for p in planets]
+    sc_mask = detrend.make_transitmask_batched(sc.time, [p.tts for p in planets], masksizes)
         
-    sc.mask = sc_mask.sum(axis=0) > 0
+    sc.mask = sc_mask.any(axis=0)
 
 else:
     sc_mask = None
 
     
 if lc is not None:
-    lc_mask = np.zeros((NPL,len(lc.time)),dtype='bool')
-    for npl, p in enumerate(planets):
-        lc_mask[npl] = detrend.make_transitmask(lc.time, p.tts, np.max([3/24,1.5*p.duration]))
+    masksizes = [np.max([3/24,1.5*p.duration]) for p in planets]
+    lc_mask = detrend.make_transitmask_batched(lc.time, [p.tts for p in planets], masksizes)
         
-    lc.mask = lc_mask.sum(axis=0) > 0
+    lc.mask = lc_mask.any(axis=0)
 
 else:
     lc_mask = None
@@ -1901,111 +1934,123 @@ else:
 # Flag high quality transits (quality = 1)
 # good transits must have  at least 50% photometry coverage in/near transit
 
+# bind the sorted-time search methods once for the window counts below
+sc_search = sc.time.searchsorted if sc is not None else None
+lc_search = lc.time.searchsorted if lc is not None else None
+
 for npl, p in enumerate(planets):
     count_expect_lc = int(np.ceil(p.duration/lcit))
     count_expect_sc = int(np.ceil(p.duration/scit))
         
     quality = np.zeros(len(p.tts), dtype='bool')
     
-    for i, t0 in enumerate(p.tts):
+    # time is sorted, so cadence counts within each window come from searchsorted bounds
+    if sc is not None:
+        p.sc_windows = np.vstack([sc_search(p.tts-1.5*p.duration, 'right'),
+                                   sc_search(p.tts+1.5*p.duration, 'left')])
         
-        if sc is not None:
-            in_sc = np.abs(sc.time - t0)/p.duration < 0.5
-            near_sc = np.abs(sc.time - t0)/p.duration < 1.5
-            
-            qual_in = np.sum(in_sc) > 0.5*count_expect_sc
-            qual_near = np.sum(near_sc) > 1.5*count_expect_sc
-            
-            quality[i] += qual_in*qual_near
+        in_sc = sc_search(p.tts+0.5*p.duration, 'left') - sc_search(p.tts-0.5*p.duration, 'right')
+        near_sc = p.sc_windows[1] - p.sc_windows[0]
         
+        qual_in = in_sc > 0.5*count_expect_sc
+        qual_near = near_sc > 1.5*count_expect_sc
         
-        if lc is not None:
-            in_lc = np.abs(lc.time - t0)/p.duration < 0.5
-            near_lc = np.abs(lc.time - t0)/p.duration < 1.5
-            
-            qual_in = np.sum(in_lc) > 0.5*count_expect_lc
-            qual_near = np.sum(near_lc) > 1.5*count_expect_lc
-            
-            quality[i] += qual_in*qual_near
-            
+        quality += qual_in*qual_near
+    
     
-    p.quality = np.copy(quality)
+    if lc is not None:
+        p.lc_windows = np.vstack([lc_search(p.tts-1.5*p.duration, 'right'),
+                                   lc_search(p.tts+1.5*p.duration, 'left')])
+        
+        in_lc = lc_search(p.tts+0.5*p.duration, 'left') - lc_search(p.tts-0.5*p.duration, 'right')
+        near_lc = p.lc_windows[1] - p.lc_windows[0]
+        
+        qual_in = in_lc > 0.5*count_expect_lc
+        qual_near = near_lc > 1.5*count_expect_lc
+        
+        quality += qual_in*qual_near
+        
+    
+    p.quality = quality
 
 
 # Flag which transits overlap (overlap = 1)
 overlap = []
 
 for i in range(NPL):
-    overlap.append(np.zeros(len(planets[i].tts), dtype='bool'))
+    # a transit overlaps if any other planet transits within 1.5 max durations
+    others = np.sort(np.concatenate([planets[j].tts for j in range(NPL) if j != i] + [np.array([])]))
     
-    for j in range(NPL):
-        if i != j:
-            for ttj in planets[j].tts:
-                overlap[i] += np.abs(planets[i].tts - ttj)/durs.max() < 1.5
+    lo = np.searchsorted(others, planets[i].tts - 1.5*durs.max(), 'right')
+    hi = np.searchsorted(others, planets[i].tts + 1.5*durs.max(), 'left')
+    
+    overlap.append(hi > lo)
                 
-    planets[i].overlap = np.copy(overlap[i])
+    planets[i].overlap = overlap[i]
 
 
 # Make phase-folded transit plots
-print("\nMaking phase-folded transit plots...\n")
+if make_plots:
+    print("\nMaking phase-folded transit plots...\n")
 
-for npl, p in enumerate(planets):
-    tts = p.tts[p.quality*~p.overlap]
+    for npl, p in enumerate(planets):
+        good = p.quality & ~p.overlap
+        tts = p.tts[good]
     
-    if len(tts) == 0:
-        print("No non-overlapping high quality transits found for planet {0} (P = {1} d)".format(npl, p.period))
+        if len(tts) == 0:
+            print("No non-overlapping high quality transits found for planet {0} (P = {1} d)".format(npl, p.period))
     
-    else:
-        t_folded = []
-        f_folded = []
-
-        # grab the data
-        for t0 in tts:
+        else:
+            # cadence ranges within 1.5 durations of each transit were cached when flagging quality
+            fold_data = []
             if sc is not None:
-                use = np.abs(sc.time-t0)/p.duration < 1.5
-                
-                if np.sum(use) > 0:
-                    t_folded.append(sc.time[use]-t0)
-                    f_folded.append(sc.flux[use])
-                    
+                fold_data.append([sc, p.sc_windows[:,good]])
             if lc is not None:
-                use = np.abs(lc.time-t0)/p.duration < 1.5
-                
-                if np.sum(use) > 0:
-                    t_folded.append(lc.time[use]-t0)
-                    f_folded.append(lc.flux[use])
-        
-        # sort the data
-        t_folded = np.hstack(t_folded)
-        f_folded = np.hstack(f_folded)
-
-        order = np.argsort(t_folded)
-        t_folded = t_folded[order]
-        f_folded = f_folded[order]
-        
-        # bin the data
-        t_binned, f_binned = bin_data(t_folded, f_folded, p.duration/11)
-        
-        # set undersampling factor and plotting limits
-        inds = np.arange(len(t_folded), dtype='int')
-        inds = np.random.choice(inds, size=np.min([3000,len(inds)]), replace=False)
-        
-        ymin = 1 - 3*np.std(f_folded) - p.depth
-        ymax = 1 + 3*np.std(f_folded)
-        
-        # plot the data
-        plt.figure(figsize=(12,4))
-        plt.plot(t_folded[inds]*24, f_folded[inds], '.', c='lightgrey')
-        plt.plot(t_binned*24, f_binned, 'o', ms=8, color='C{0}'.format(npl), label="{0}-{1}".format(TARGET, npl))
-        plt.xlim(t_folded.min()*24, t_folded.max()*24)
-        plt.ylim(ymin, ymax)
-        plt.xticks(fontsize=14)
-        plt.yticks(fontsize=14)
-        plt.xlabel("Time from mid-transit [hrs]", fontsize=20)
-        plt.ylabel("Flux", fontsize=20)
-        plt.legend(fontsize=20, loc='upper right', framealpha=1)
-        plt.savefig(FIGURE_DIR + TARGET + '_folded_transit_{0:02d}.png'.format(npl), bbox_inches='tight')
-        if ~iplot: plt.close()
+                fold_data.append([lc, p.lc_windows[:,good]])
+        
+            # allocate the folded arrays once and fill them window by window
+            total = int(np.sum([np.sum(windows[1] - windows[0]) for x, windows in fold_data]))
+        
+            t_folded = np.empty(total, dtype='float')
+            f_folded = np.empty(total, dtype='float')
+        
+            # grab the data
+            offset = 0
+            for x, windows in fold_data:
+                for t0, (lo, hi) in zip(tts, windows.T):
+                    n = hi - lo
+                    t_folded[offset:offset+n] = x.time[lo:hi] - t0
+                    f_folded[offset:offset+n] = x.flux[lo:hi]
+                    offset += n
+        
+            # sort the data
+            order = np.argsort(t_folded)
+            t_folded = t_folded[order]
+            f_folded = f_folded[order]
+        
+            # bin the data
+            t_binned, f_binned = bin_data(t_folded, f_folded, p.duration/11)
+        
+            # set undersampling factor and plotting limits; data are sorted, so a fixed stride samples evenly in phase
+            inds = slice(None, None, int(np.ceil(len(t_folded)/3000)))
+        
+            f_std = np.std(f_folded)
+            ymin = 1 - 3*f_std - p.depth
+            ymax = 1 + 3*f_std
+        
+            # plot the data
+            plt.figure(figsize=(12,4))
+            plt.plot(t_folded[inds]*24, f_folded[inds], '.', c='lightgrey')
+            plt.plot(t_binned*24, f_binned, 'o', ms=8, color='C{0}'.format(npl), label="{0}-{1}".format(TARGET, npl))
+            plt.xlim(t_folded[0]*24, t_folded[-1]*24)
+            plt.ylim(ymin, ymax)
+            plt.xticks(fontsize=14)
+            plt.yticks(fontsize=14)
+            plt.xlabel("Time from mid-transit [hrs]", fontsize=20)
+            plt.ylabel("Flux", fontsize=20)
+            plt.legend(fontsize=20, loc='upper right', framealpha=1)
+            plt.savefig(FIGURE_DIR + TARGET + '_folded_transit_{0:02d}.png'.format(npl), bbox_inches='tight')
+            if ~iplot: plt.close()
 
 
 # Save detrended lightcurves